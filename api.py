@@ -1,9 +1,16 @@
-from bottle import error, get, post, run, request, route, redirect
+from bottle import BaseRequest, error, get, post, run, request, route, redirect
 import fountain
 import queries
 import constants
+from patternfile import encodeEvents, encodeFrames
+from patterns import checkEvents, checkFrames
+from scheduler import QueueIndex
+import sqlite3
 from time import time
 
+# Whole patterns are uploaded as JSON, which can be much bigger than Bottle's default limit on request bodies.
+BaseRequest.MEMFILE_MAX = constants.MAX_REQUEST_SIZE
+
 # ######################################################################################################################
 # Defaults and Errors
 # ######################################################################################################################
@@ -34,6 +41,17 @@ def gDefaultResponse():
 # ###
 # Helper Functions
 # ###
+
+# Event shared with the background process, set whenever the control queue or valves change. See startAPI().
+backgroundWakeup = None
+
+
+def wakeBackground():
+    """Wakes the background processing up so it handles a change right away, instead of at its next poll."""
+    if backgroundWakeup is not None:
+        backgroundWakeup.set()
+
+
 def log(msg):
     """Prints a message alongside the IP of the client that generated it."""
     print('[' + request.remote_addr + '] ' + msg)
@@ -114,68 +132,49 @@ def jsonRows(cursor):
 
     return responseDict
 
-def getTrueEta(controllerID):
-    """Assuming this controller were to be in position zero, about how long would it have control?"""
-    con = fountain.db_connect()
-    c = con.cursor()
-
-    ret = -2
+# The API keeps its own connection and index of the live control queue for answering queue position queries, which
+# hundreds of waiting clients poll. See getQueueIndex().
+queueIndexCon = None
+queueIndex = None
+queueIndexVersion = None
+queueIndexDataVersion = None
 
-    for row in c.execute(queries.QUERY_CONTROL_QUEUE):
-        if int(row[0]) != int(controllerID):
-            continue
 
-        if row[1] > 0:
-            ret = row[1] + row[2] - time()
-            break
-        else:
-            ret = 0
-
-    fountain.db_close(con)
+def getQueueIndex():
+    """Returns an index of the live control queue, only rebuilt when the queue has changed since the last call."""
+    global queueIndexCon, queueIndex, queueIndexVersion, queueIndexDataVersion
 
-    return ret
+    if queueIndexCon is None:
+        queueIndexCon = fountain.db_connect()
 
-def getTrueQueuePosition(controllerID):
-    """Taking into account priority and acquisition time, determines the true queue position"""
-    estimate = -1
+    # Everything which changes the queue (the background processing and the other API routes) commits through some
+    # other connection, so if data_version hasn't changed, nothing has. It changes on every commit though, heartbeats
+    # and valve writes included, so then the controlQueueVersion counter tells us whether the queue itself did.
+    dataVersion = queueIndexCon.execute(queries.QUERY_DATA_VERSION).fetchone()[0]
+    if queueIndex is not None and dataVersion == queueIndexDataVersion:
+        return queueIndex
+    queueIndexDataVersion = dataVersion
 
-    # This will look very similar to the code in the background processing script, but here we'll be counting how many
-    # controllerIDs are ahead of us.
-    con = fountain.db_connect()
-    c = con.cursor()
+    version = queueIndexCon.execute(queries.QUERY_CONTROLQUEUE_VERSION).fetchone()[0]
+    if queueIndex is None or version != queueIndexVersion:
+        queueIndex = QueueIndex(fountain.db_readLiveControlQueue(queueIndexCon))
+        queueIndexVersion = version
 
-    # Check if we're even in the queue. If not, don't return anything.
-    c.execute(queries.CHECK_IF_IM_IN_THE_QUEUE, {'controllerID': controllerID})
-    r = c.fetchone()
+    return queueIndex
 
-    if r[0] == 0:
-        print ("Not even in the queue... Controller ID is in position 0 already: " + str(controllerID))
-        fountain.db_close(con)
-        return -2
 
+def getTrueQueueInfo(controllerID):
+    """
+    Taking into account priority and acquisition time, determines the true queue position of a controller across all
+    priority levels (0 means it's in control), about how many seconds until it gets control, and how many seconds of
+    control it has (left). All of these are -2 if the controller isn't (or isn't yet) in the queue.
+    """
+    info = getQueueIndex().lookup(int(controllerID), time())
+    if info is None:
+        return -2, -2, -2
 
-    c.execute("SELECT queuePosition FROM controlQueue WHERE controllerID=:controllerID", {'controllerID': controllerID})
-    r = c.fetchone()
-    n = r[0]
-    fountain.db_close(con)
+    return info
 
-    return n
-
-    # We need to check the queue of valid items at the maximum priority level, and all these below it. Group the
-    # priority levels and descend them to estimate how long it will be.
-    # for r in c.execute(queries.GET_PRIORITY_LEVELS):
-    #     for row in c.execute(queries.GET_QUEUE_AT_PRIORITY, {'priority': r[0]}):
-    #         # These are ordered with the highest priority first. Check until we find us.
-    #         if int(row[3]) != int(controllerID):
-    #             print(" incrementing priority")
-    #             estimate += 1
-    #         else:
-    #             # Done!
-    #             fountain.db_close(con)
-    #             return estimate  # We'll fall out of the loop due to closing the database on top of the iterator.
-    #
-    # fountain.db_close(con)
-    # return estimate  # Don't change
 
 # ######################################################################################################################
 # Authentication and Control
@@ -203,8 +202,8 @@ def pQueryControl():
     if not 'controllerID' in request.json.keys():
         return {'success': 'false', 'message': 'Must specify controllerID to query.'}
 
-    # TODO: Implement ETA too
-    return {'success': 'true', 'trueQueuePosition': getTrueQueuePosition(request.json['controllerID']), 'eta': getTrueEta(request.json['controllerID'])}
+    position, eta, remaining = getTrueQueueInfo(request.json['controllerID'])
+    return {'success': 'true', 'trueQueuePosition': position, 'eta': eta, 'remaining': remaining}
 
 
 @post('/api/control/request')
@@ -228,6 +227,7 @@ def pRequestControl():
     # No concurrency worries with lastrowid, I think, as it's per-connection.
     controllerID = c.lastrowid
     fountain.db_close(con)
+    wakeBackground()
 
     # TODO: Implement variable length TTL part and some additional sanity checks.
     return {'success': 'true', 'ttl': request.json['requestedLength'], 'controllerID': controllerID}
@@ -246,10 +246,31 @@ def pReleaseControl():
     c = con.cursor()
     c.execute(queries.RELEASE_CONTROL, {'controllerID': request.json['controllerID']})
     fountain.db_close(con)
+    wakeBackground()
 
     return {'success': 'true', 'message': 'Control released.'}
 
 
+@post('/api/control/heartbeat')
+def pHeartbeatControl():
+    """
+    Renews the lease of a specific controllerID. Once a controller has sent a heartbeat it has to keep sending them, at
+    least every leaseTimeout seconds, or it loses control - so clients which go away don't hold up the queue.
+    """
+    if not checkAPIKey():
+        return getAPIKeyFail()
+
+    if not 'controllerID' in request.json.keys():
+        return {'success': 'false', 'message': 'Must specify controllerID to renew.'}
+
+    con = fountain.db_connect()
+    c = con.cursor()
+    c.execute(queries.HEARTBEAT_CONTROL, {'controllerID': request.json['controllerID'], 'now': time()})
+    fountain.db_close(con)
+
+    return {'success': 'true', 'leaseTimeout': constants.LEASE_TIMEOUT}
+
+
 # ######################################################################################################################
 # Valve Interaction
 # ######################################################################################################################
@@ -288,7 +309,9 @@ def pValves():
         c.execute(queries.SET_VALVE, {'spraying': val, 'id': i})
         bm >>= 1
 
+    c.execute(queries.TOUCH_CONTROL_ACTIVITY, {'controllerID': request.json['controllerID'], 'now': time()})
     fountain.db_close(con)
+    wakeBackground()
     return {'success': 'true'}
 
 
@@ -327,7 +350,9 @@ def pValvesID(id):
     # TODO: check control
 
     c.execute(queries.SET_VALVE, {'spraying': int(request.json['spraying']), 'id': id})
+    c.execute(queries.TOUCH_CONTROL_ACTIVITY, {'controllerID': request.json['controllerID'], 'now': time()})
     fountain.db_close(con)
+    wakeBackground()
 
     return {'success': 'true'}
 
@@ -349,6 +374,44 @@ def gPatterns():
     return res
 
 
+@post('/api/patterns')
+def pPatterns():
+    """
+    Uploads a new pattern, given a name (and optionally a description) and either its events, as a list of [time in
+    milliseconds, valve, action] lists, or its frames, as a list of valve bitmasks which last frameLength milliseconds
+    each. Returns the new pattern's ID. The pattern isn't engaged. It's stored encoded as runs of frames (see
+    patternfile.py), which is much smaller and quicker to write than a row per event.
+    """
+    if not checkAPIKey():
+        return getAPIKeyFail()
+
+    if not 'name' in request.json.keys():
+        return {'success': 'false', 'message': 'Must specify a name for the pattern.'}
+
+    description = request.json.get('description')
+    if description is not None and not isinstance(description, str):
+        return {'success': 'false', 'message': 'The description of the pattern must be a string.'}
+
+    try:
+        if 'events' in request.json.keys():
+            runs = encodeEvents(checkEvents(request.json['events']))
+        elif 'frames' in request.json.keys():
+            checkFrames(request.json['frames'], request.json.get('frameLength'))
+            runs = encodeFrames(request.json['frameLength'], request.json['frames'])
+        else:
+            return {'success': 'false', 'message': 'Must specify either events or frames for the pattern.'}
+    except (TypeError, ValueError) as e:
+        return {'success': 'false', 'message': str(e)}
+
+    try:
+        patternID = fountain.db_createPattern(str(request.json['name']), description, runs=runs)
+    except sqlite3.IntegrityError:
+        return {'success': 'false', 'message': 'A pattern with that name already exists.'}
+
+    log('Created pattern ' + str(patternID) + ' (' + str(len(runs)) + ' bytes).')
+    return {'success': 'true', 'patternID': patternID}
+
+
 @post('/api/patterns/<id>')
 def pPatternsID(id):
     """Sets a specific pattern to active."""
@@ -359,12 +422,18 @@ def pPatternsID(id):
         return {'success': 'false', 'message': 'Need to provide controllerID.'}
 
     # TODO: check for control
-    # TODO: also disengage other patterns from playing (probably a separate query to run before this one)
 
+    # Only one pattern plays at a time, so engaging one disengages the rest - unless it couldn't be engaged.
     con = fountain.db_connect()
     c = con.cursor()
     c.execute(queries.ENGAGE_PATTERN, {'id': id})
+    if c.rowcount == 0:
+        fountain.db_close(con)
+        return {'success': 'false', 'message': 'Invalid pattern ID.'}
+
+    c.execute(queries.DISENGAGE_OTHER_PATTERNS, {'id': id})
     fountain.db_close(con)
+    wakeBackground()
 
     return {'success': 'true'}
 
@@ -388,7 +457,10 @@ def gDBPop():
     return "ok"
 
 
-def startAPI():
-    """Starts the server API."""
+def startAPI(wakeup=None):
+    """Starts the server API. The optional wakeup event is set whenever the background processing should run early."""
+    global backgroundWakeup
+    backgroundWakeup = wakeup
+
     print("API hook started...")
     run(host='0.0.0.0', port=8080, quiet=True)
\ No newline at end of file
@@ -1,12 +1,18 @@
-from multiprocessing import Process
-from time import sleep, time
+from multiprocessing import Event, Process
+import signal
+from time import monotonic, sleep, time
 
 import constants
 import fountain
 import queries
 from api import startAPI
-import socket
-import struct
+from frameclock import FrameClock
+from metrics import OutputMetrics
+from output import FrameSender, SharedFrame, TimelineSender
+from patternfile import FileTimeline, PatternFile, PatternRuns
+from patterns import PatternCache, compileEvents, compileSteps
+from scheduler import ControlScheduler
+import sqlite3
 from datetime import datetime
 
 
@@ -15,225 +21,413 @@ defaultPattern = [16, 0, 68, 0, 69632, 0, 278528, 0, 34, 0, 557056, 0, 136, 0, 1
                   1052672, 0, 514, 0, 2105344, 0, 4096, 0, 65552, 0, 16388, 0, 262208, 0, 8194, 0, 131104, 0, 32776, 0,
                   524416]
 
-def backgroundProcessing():
-    """
-    This method is called to initiate the background processing of the fountain, which includes advancing the control
-    queue, running the patterns, and sending the current state to the cRIO.
-    """
-    patternTick = 0
-    # Now supposedly, SQLite3 Python bindings allow for this kind of multithreading without any special locking/mutex
-    # effort on our part, as long as we don't re-use the same connection object across different threads. That is, the
-    # following should be entirely thread-safe ("process" safe), and any modifying queries will automagically wait on
-    # existing queries to finish!
+def waitForWakeup(wakeup, timeout):
+    """Sleeps for up to timeout seconds. Returns True if the API set the wakeup event in the meantime."""
+    timeout = max(timeout, 0)
+    if wakeup is None:
+        sleep(timeout)
+        return False
 
-    tablesChecked = False
-    controlledBy = -1  # The current controllerID which should be allowed to control the fountain. -1 if in patterns.
-
-    # Main background processing loop.
-    while True:
-        sleep(1)
+    woken = wakeup.wait(timeout)
+    if woken:
+        wakeup.clear()
+    return woken
 
-        # First, check if a control queue exists. If it doesn't, create it.
-        if not tablesChecked:
-            print("Checking if controlQueue exists...")
-
-            con = fountain.db_connect()
-            c = con.cursor()
-            c.execute(queries.CHECK_IF_CONTROL_QUEUE_EXISTS)
-
-            r = c.fetchone()
-            fountain.db_close(con)
-
-            if r[0] == 0:
-                print("... it doesn't. Creating and populating default tables, if they don't exist...")
-                fountain.db_createTables()
-                fountain.db_loadDefaults()
-                print("... OK.")
-            else:
-                print("... it does.")
+class BackgroundProcessor:
+    """
+    Everything the background processing does on a single tick: advancing the control queue, running the patterns and
+    sending the current state to the cRIO. The wall clock, the monotonic clock the frames are timed on and the output
+    are all injected, so that a tick can be stepped through deterministically - and faster than real time - by the
+    benchmarks. backgroundProcessing() drives one of these off the real clocks. Without an injected send function,
+    states go to the cRIO through a FrameSender - or, in the "timeline" output mode, upcoming frames are streamed to it
+    through a TimelineSender (or an injected stream function) instead.
+    """
 
-            tablesChecked = True
-            print("Background processing started...")
+    def __init__(self, clock=time, monotonicClock=monotonic, send=None, stream=None):
+        # Now supposedly, SQLite3 Python bindings allow for this kind of multithreading without any special
+        # locking/mutex effort on our part, as long as we don't re-use the same connection object across different
+        # threads. That is, the following should be entirely thread-safe ("process" safe), and any modifying queries
+        # will automagically wait on existing queries to finish!
+        self.clock = clock
+        self.frameClock = FrameClock(constants.FRAME_RATE, monotonicClock)
+        if send is None and stream is None and constants.OUTPUT_MODE == "timeline":
+            stream = TimelineSender(constants.CRIO_ADDRESS, self.frameClock.period, constants.TIMELINE_HORIZON).stream
+        elif send is None and stream is None:
+            sender = FrameSender(constants.CRIO_ADDRESS, constants.KEEPALIVE_INTERVAL, monotonicClock,
+                                 self.frameClock.period / 2)
+            sender.precompile(defaultPattern)
+            send = sender.send
+        self.send = send
+        self.stream = stream
+
+        # The timeline of the pattern playing when nobody is in control (see patterns.py), the ID and version of the
+        # pattern it was compiled from (None for the default pattern), and the frame it started playing on.
+        self.defaultTimeline = compileSteps(defaultPattern, constants.DEFAULT_PATTERN_STEP, self.frameClock.period)
+        self.patternCache = PatternCache(constants.PATTERN_CACHE_BYTES)
+        self.timeline = self.defaultTimeline
+        self.patternID = None
+        self.patternVersion = None
+        self.patternStart = 0
+        self.patternTick = 0
+        # The current controllerID which should be allowed to control the fountain. -1 if in patterns.
+        self.controlledBy = -1
+        self.scheduler = None
+        self.con = None  # Our one long-lived database connection, only re-opened after an error.
+        self.valveState = 0  # The valve states as last read from the database, for when somebody is in control.
+        self.printedState = None  # The controller's valve states we last printed...
+        self.isNightTime = None  # ...and whether it was night, so that we only print changes.
+        self.nextPoll = 0  # When we should read the database even if the API hasn't woken us up.
+        self.nextArchive = 0  # When the control queue retention job should run next.
+        self.nextLivenessCheck = float('inf')  # When the controller in control may have gone idle or missed heartbeats.
+        self.nextReport = clock() + constants.FRAME_REPORT_INTERVAL
+        self.metrics = OutputMetrics()
+
+    def checkTables(self):
+        """Checks if a control queue exists. If it doesn't, creates it, otherwise brings its schema up to date."""
+        print("Checking if controlQueue exists...")
 
-        # The first task is to check our database to see if any items in the queue are pending assignment (with position
-        # as -1). Take these items and add them to their corresponding priority queues. When an item reaches the front of
-        # the queue, update its acquire time from -1 to the current time.
         con = fountain.db_connect()
         c = con.cursor()
-        c.execute(queries.FIND_PENDING_CONTROL_REQUESTS)
-
-        rows = c.fetchall()
-
-        # Only bother if there are actually rows..
-        if len(rows) > 0:
-
-            # Find maximum queue position for each priority. The queue position is the 1th entry in the row.
-            nextQueuePositionForPriority = {}
-            for row in rows:
-                if not row[1] in nextQueuePositionForPriority.keys():
-                    c.execute(queries.FIND_MAX_QUEUE_POSITION_FOR_PRIORITY, {'priority': row[1]})
-                    max = c.fetchone()[0]
-
-                    if max is None or max < 0:
-                        max = -1
-
-                    nextQueuePositionForPriority[row[1]] = max + 1
-
-            # Now, while incrementing the next queue positions, add these things to the database.
-            for row in rows:
-                print('Queueing cID ' + str(row[0]) + ' as position ' + str(
-                    nextQueuePositionForPriority[row[1]]) + ' in priority ' + str(row[1]) + ' queue.')
-
-                c.execute(queries.SET_QUEUE_POSITION,
-                          {'controllerID': row[0], 'queuePosition': nextQueuePositionForPriority[row[1]]})
-
-                # If a controller becomes in control, set its acquired time to now.
-                if nextQueuePositionForPriority[row[1]] == 0:
-                    print('Setting acquire time to now for cID ' + str(row[0]))
-                    c.execute(queries.SET_CONTROL_ACQUIRED_TIME_TO_NOW, {'controllerID': row[0]})
-
-                nextQueuePositionForPriority[row[1]] += 1
-
-        # Check if currently running request needs to be booted out due to either expiring or a higher priority request,
-        # and if so, update queuePosition and acquire times on all affected requests.
-        # If a request becomes invalid, set its TTL to 0 and queuePosition to -2.
-
-        # First, find the controller who is currently in control. Find highest priority, and then check that queue.
-        c.execute(queries.FIND_MAX_PRIORITY_IN_QUEUE)
-        max = c.fetchone()[0]
-
-        if max is None:
-            # Nothing's in the queue!
-            controlledBy = -1
-
-        # See if there's a 0th-position item in this queue. If so, check the time to make sure it's still valid. If it's
-        # not, or there is no such item, go through the rest of this queue until we find a valid record to set as the
-        # new controller. If we can't find one (because we run out or a bunch of TTL = 0 records exist), drop down to the
-        # next priority level and start from there (i.e. re-call the max priority finding query). If we have run out of
-        # control requests completely, set controlledBy to -1 so the defailt patterns can engage.
-        discoveringInvalidItems = True  # At first glance seems unnecessary, but there could be junk records (TTL = 0)
-        while discoveringInvalidItems:
-            # During this loop, we might have to drop down a priority level. We might even run out of valid items
-            # entirely - in which case we'll need to set controlledBy to -1.
-
-            # We need to check the queue of valid items at the maximum priority level.
-            for row in c.execute(queries.GET_QUEUE_AT_PRIORITY, {'priority': max}):
-                # These are ordered with the highest priority first. Check the times until we find a valid item. If we
-                # find an invalid item, set its queuePosition to -2 and set the next valid item in the queue to position
-                # 0, with an acquire time of now. Astute readers will note that this will result in non-contiguous
-                # queuePositions for the requests, but this does not matter as we treat the request list as a queue,
-                # only adding items to the max + 1 and only taking items off the front.
-
-                # First, check if it's queuePosition is 0. If it's not, it likely has an acquire time of -1 and needs to
-                # be scheduled anyway (providing its TTL > 0, otherwise kill that record). We could run into records
-                # waiting in the queue whose owners have released control (given up on) and their TTLs will be 0.
-                if row[2] == 0:
-                    # Currently in control, check its validity.
-                    if row[0] + row[1] > time():
-                        # Still valid, set this to be the controller
-                        print("controllerID " + str(row[3]) + " remains in control for " + str(
-                            row[0] + row[1] - time()) + " seconds...")
-                        controlledBy = row[3]
-                        discoveringInvalidItems = False
-                        break
-                    else:
-                        # Invalid, need to clear it and continue.
-                        print("controllerID " + str(row[3]) + " has expired, setting its queuePosition to -2.")
-                        # XXX: So, this is a query modifying the controlQueue while we're currently iterating through it
-                        # I don't know if Python/SQLite bindings are smart enough to figure this one out, it might be a
-                        # problem...
-                        c.execute(queries.SET_QUEUE_POSITION, {'controllerID': row[3], 'queuePosition': -2})
-
-                        # Drop out to the for loop and we'll now find some non-0 position items which will be promoted.
-                        continue  # TODO: If it does work, this is really easy. If not, that's a lot more work.
-                else:
-                    # Check that this item at least has a TTL > 0
-                    if not row[1] > 0:
-                        # Done with that request...
-                        c.execute(queries.SET_QUEUE_POSITION, {'controllerID': row[3], 'queuePosition': -2})
-                        continue
-
-                    # This item needs to be promoted to the front of the queue.
-                    c.execute(queries.SET_QUEUE_POSITION, {'controllerID': row[3], 'queuePosition': 0})
-                    c.execute(queries.SET_CONTROL_ACQUIRED_TIME_TO_NOW, {'controllerID': row[3]})
-                    print("New controllerID in control: " + str(row[3]))
-                    discoveringInvalidItems = False
-                    break
-
-            # Now, since we got here, we know that we haven't found a valid item at this priority, having gone through
-            # all of them. We need to drop down to the next priority level, or decide that we're completely done if we
-            # have exhausted all priority levels in the queue.
-            c.execute(queries.FIND_MAX_PRIORITY_IN_QUEUE)
-            max = c.fetchone()[0]
-
-            if max is None:
-                # Nothing's in the queue!
-                print("Queue empty...")
-                controlledBy = -1
-                discoveringInvalidItems = False
-
-            
-        if patternTick is None:
-            patternTick = 0
-        # Advance patterns if nothing else is in control.
-        if controlledBy == -1:
-            # Default patterns should be able to run here
-            if patternTick >= len(defaultPattern) - 1:
-                patternTick = 0
-            else:
-                patternTick += 1
-            
-            print('... pattern tick.')
+        c.execute(queries.CHECK_IF_CONTROL_QUEUE_EXISTS)
 
+        r = c.fetchone()
+        fountain.db_close(con)
 
+        if r[0] == 0:
+            print("... it doesn't. Creating and populating default tables, if they don't exist...")
+            fountain.db_createTables()
+            fountain.db_loadDefaults()
+            print("... OK.")
+        else:
+            print("... it does. Migrating it to the current schema...")
+            fountain.db_migrate()
+
+        for name, detail in fountain.db_checkQueryPlans():
+            print("WARNING: query " + name + " is not using an index (" + detail + ")")
+
+    def timeUntilNextEvent(self, now):
+        """
+        Returns how long we can sleep for at wall clock time now: until the earliest of the next frame, the current
+        controller's control running out, its liveness check and the next fallback poll. Nothing can change before
+        then, unless the API wakes us up. Frames are timed on the monotonic frame clock, everything else on the wall
+        clock as that's what the database stores.
+        """
+        timeout = min(self.frameClock.untilNextFrame(), self.nextPoll - now, self.nextLivenessCheck - now)
+        deadline = self.scheduler.nextDeadline() if self.scheduler is not None else None
+        if deadline is not None:
+            timeout = min(timeout, deadline - now)
+        return timeout
+
+    def step(self, now, woken=False):
+        """
+        Runs a single tick at wall clock time now. Woken says whether the API has told us something changed. Returns
+        the state which was sent to the fountain, or None if the tick was skipped because of a database error.
+        """
+        # Each tick is split into three phases, so that we never hold a lock on the database while deciding anything:
+        #
+        # 1. Read a snapshot of what changed: the requests pending assignment to a priority queue (with position as -1),
+        #    and those released through the API (with their TTL set to 0). The API wakes us up whenever it changes one
+        #    of these, so when we were woken by a deadline or a frame there's nothing to read unless a poll is due.
+        # 2. Hand the snapshot to the scheduler, which keeps the live queue in memory. It queues the pending requests,
+        #    drops the released ones, and checks if the currently running request needs to be booted out due to either
+        #    expiring or a higher priority request, promoting the next valid one. If we have run out of control requests
+        #    completely, controlledBy becomes -1 so the default patterns can engage.
+        # 3. Write all of the resulting queue positions and acquire times back in one batch, so the API can see them.
+        #
+        # If anything goes wrong with the database, drop the connection and skip this tick. The next one reconnects and
+        # rebuilds the in-memory queue from the database, which only ever has decisions that were fully written back.
+        try:
+            if self.con is None:
+                self.con = fountain.db_connectBackground()
+                self.scheduler = ControlScheduler(constants.FAIR_QUEUEING, constants.FAIR_QUEUEING_WEIGHTS,
+                                                  constants.AGING_RATE)
+                self.scheduler.load(fountain.db_readLiveControlQueue(self.con), now)
+                woken = True  # Freshly (re)connected, so catch up on everything.
+
+            readDatabase = woken or now >= self.nextPoll
+            if readDatabase:
+                pending, released = fountain.db_readControlChanges(self.con)
+                self.nextPoll = now + constants.POLL_INTERVAL
+            else:
+                pending, released = [], []
+
+            # A controller which has stopped sending heartbeats or valve writes is released, just as if it had asked.
+            if self.controlledBy != -1 and now >= self.nextLivenessCheck and self.checkLiveness(now):
+                released.append(self.controlledBy)
+
+            previousController = self.controlledBy
+            self.controlledBy, transitions = self.scheduler.decide(pending, released, now)
+
+            # Nobody can have gone idle before the shorter timeout has passed since they acquired control, so there's no
+            # need to look before then.
+            if self.controlledBy != previousController:
+                self.nextLivenessCheck = float('inf')
+                timeouts = [t for t in (constants.LEASE_TIMEOUT, constants.IDLE_TIMEOUT) if t is not None]
+                if self.controlledBy != -1 and timeouts:
+                    self.nextLivenessCheck = self.scheduler.entries[self.controlledBy].acquire + min(timeouts)
+
+            fountain.db_applyTransitions(self.con, transitions)
+
+            if self.controlledBy != -1 and (readDatabase or self.controlledBy != previousController):
+                self.valveState = fountain.db_readValveState(self.con)
+
+            # The API wakes us up when a pattern is engaged, too.
+            if readDatabase:
+                self.checkActivePattern()
+        except sqlite3.Error as e:
+            print("Database error, reconnecting on the next tick: " + str(e))
+            self.disconnect()
+            return None
+
+        # Advance patterns if nothing else is in control, and it's time for the next frame. The pattern's position comes
+        # from the frame index rather than being counted up, so it keeps in time even when the frame clock skips frames.
+        frame = self.frameClock.tick()
+        if frame is not None:
+            self.metrics.overrun.record(self.frameClock.lastLateness)
+        if self.controlledBy == -1 and frame is not None:
+            self.patternTick = (frame - self.patternStart) % len(self.timeline)
+
+        if now >= self.nextReport:
+            print("Frame clock: " + self.frameClock.report())
+            waits = self.scheduler.waitMetrics(now)
+            if waits:
+                print("Longest waits: " + ", ".join("priority " + str(p) + " " + str(round(waits[p], 1)) + " s"
+                                                    for p in sorted(waits, reverse=True)))
+            self.nextReport = now + constants.FRAME_REPORT_INTERVAL
+
+        # Ticks run up to 50 times a second, so only say when day turns to night and back.
         isNightTime = False
-        dt = datetime.now()
+        dt = datetime.fromtimestamp(now)
         if dt.hour < 6 or dt.hour >= 19:
             isNightTime = True
-            print("It's nighttime hour " + str(dt.hour))
-        else:
-            print("It's daytime hour " + str(dt.hour))
-            
-        # Query the state of the fountain from the database...
-        state = 0
-        idx = 0
-        if controlledBy == -1:
-            state = defaultPattern[patternTick]
+        if isNightTime != self.isNightTime:
+            print(("It's nighttime hour " if isNightTime else "It's daytime hour ") + str(dt.hour))
+            self.isNightTime = isNightTime
+
+        # Work out the state of the fountain...
+        if self.controlledBy == -1:
+            state = self.timeline[self.patternTick]
             if isNightTime:
                 state = 0
         else:
-            for row in c.execute(queries.QUERY_VALVES):
-                # TODO: Might need to make sure the valves in this bitmask correspond to what the cRIO knows.
-                state |= int(row[3]) << idx
-                idx += 1
-            print("Current state is: " + str(state))
-
-        # ...and send it to the fountain.
-        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM) #  UDP socket
-        horizontals = (((state >> 20) & 15) << 8) | ((state >> 12) & 255)
-        verticals = (((state >> 8) & 15) << 8) | (state & 255)
-        payload = struct.pack(">HH", horizontals, verticals)
-        payload = b'\x01' + payload  # Add opcode byte
-        sock.sendto(payload, ("128.104.196.80", 30096))
-        print(payload)
+            state = self.valveState
+            if state != self.printedState:
+                print("Current state is: " + str(state))
+                self.printedState = state
+
+        # ...and send it to the fountain, if it changed or the keepalive is due. When streaming, the fountain gets what
+        # the next frames will be as far as we know now: the rest of the pattern, or the controller's valves held.
+        decided = self.frameClock.clock()
+        if self.stream is not None:
+            # The frame we just claimed, or the one still playing if none was due.
+            current = max(0, self.frameClock.frame - 1)
+            count = max(1, int(round(constants.TIMELINE_HORIZON / self.frameClock.period)))
+            if self.controlledBy == -1 and not isNightTime:
+                upcoming = [self.patternState(f) for f in range(current, current + count)]
+            else:
+                upcoming = [state] * count
+            sent = self.stream(current, upcoming)
+        else:
+            sent = self.send(state)
+        if sent:
+            self.metrics.sent(self.frameClock.clock(), decided)
 
         # TODO: make patterns update in database so users can query
-        
 
-        fountain.db_close(con)
+        # Every so often, move a batch of expired requests out of the live table. This runs after the state has been
+        # sent, and if there was more than a batch to do we carry on next tick rather than holding up this one.
+        if now >= self.nextArchive:
+            try:
+                if fountain.db_archiveControlQueue(self.con, now):
+                    self.nextArchive = 0
+                else:
+                    self.nextArchive = now + constants.ARCHIVE_INTERVAL
+            except sqlite3.Error as e:
+                print("Database error while archiving, reconnecting on the next tick: " + str(e))
+                self.disconnect()
+
+        return state
+
+    def patternState(self, frame):
+        """Returns the state the playing pattern has on the given frame."""
+        return self.timeline[(frame - self.patternStart) % len(self.timeline)]
+
+    def checkActivePattern(self):
+        """
+        Switches to the engaged pattern if it (or its data) has changed, starting it on the next frame. A pattern which
+        was imported from a pattern file plays straight from the file, if it's still there, and encoded patterns play
+        straight from their runs. Otherwise, patterns we've played before come out of the cache, and others are compiled
+        into a timeline first. With no pattern engaged, or one which can't be played, the default pattern plays.
+        """
+        patternID, version, file, encoded = fountain.db_readActivePattern(self.con)
+        if patternID == self.patternID and version == self.patternVersion:
+            return
+
+        timeline = self.defaultTimeline
+        if patternID is not None:
+            timeline = self.patternCache.get(patternID, version)
+            if timeline is None and file is not None:
+                try:
+                    timeline = FileTimeline(PatternFile(file), self.frameClock.period)
+                except (OSError, ValueError) as e:
+                    print("Can't play pattern " + str(patternID) + " from its file: " + str(e))
+            if timeline is None and encoded:
+                try:
+                    runs = PatternRuns(fountain.db_readPatternRuns(self.con, patternID), "Pattern " + str(patternID))
+                    timeline = FileTimeline(runs, self.frameClock.period)
+                except ValueError as e:
+                    print("Can't play pattern " + str(patternID) + ", playing the default pattern instead: " + str(e))
+                    timeline = self.defaultTimeline
+            if timeline is None:
+                try:
+                    timeline = compileEvents(fountain.db_readPatternEvents(self.con, patternID), self.frameClock.period)
+                    self.patternCache.put(patternID, version, timeline)
+                except (ValueError, MemoryError) as e:
+                    # A pattern stretching over days of frames can be too big to compile - rather than lose the whole
+                    # background processing over it, carry on with the default pattern.
+                    print("Can't play pattern " + str(patternID) + ", playing the default pattern instead: " + str(e))
+                    timeline = self.defaultTimeline
+            print("Engaged pattern " + str(patternID) + ", " + str(len(timeline)) + " frames long.")
+
+        self.patternID = patternID
+        self.patternVersion = version
+        self.timeline = timeline
+        self.patternStart = self.frameClock.frame
+
+    def checkLiveness(self, now):
+        """
+        Checks whether the controller in control has missed its heartbeats (if it ever sent one), or has gone without a
+        valve write for too long. Returns True if it should lose control, otherwise schedules the next check for when
+        the earlier of the two would run out.
+        """
+        heartbeat, activity = fountain.db_readControlLiveness(self.con, self.controlledBy)
+        acquire = self.scheduler.entries[self.controlledBy].acquire
+
+        leaseDeadline = float('inf')
+        if constants.LEASE_TIMEOUT is not None and heartbeat >= 0:
+            leaseDeadline = max(heartbeat, acquire) + constants.LEASE_TIMEOUT
+
+        idleDeadline = float('inf')
+        if constants.IDLE_TIMEOUT is not None:
+            idleDeadline = max(activity, acquire) + constants.IDLE_TIMEOUT
+
+        if leaseDeadline <= now:
+            print("controllerID " + str(self.controlledBy) + " has missed its heartbeats, releasing it.")
+            return True
+        if idleDeadline <= now:
+            print("controllerID " + str(self.controlledBy) + " has been idle for too long, releasing it.")
+            return True
+
+        self.nextLivenessCheck = min(leaseDeadline, idleDeadline)
+        return False
+
+    def disconnect(self):
+        """Drops our database connection, so that the next tick reconnects and rebuilds the in-memory queue."""
+        if self.con is not None:
+            self.con.close()
+        self.con = None
+
+def dumpMetricsOnSignal(metrics):
+    """Prints the output timing histograms whenever this process gets a SIGUSR1 (e.g. kill -USR1 <pid>)."""
+    def dump(signum, frame):
+        print("Output timing:\n" + metrics.report())
+
+    signal.signal(signal.SIGUSR1, dump)
+
+
+def backgroundProcessing(wakeup=None, frameName=None, published=None):
+    """
+    This method is called to initiate the background processing of the fountain, which includes advancing the control
+    queue, running the patterns, and sending the current state to the cRIO. The API process sets the optional wakeup
+    event whenever it changes something we care about, so we don't have to wait for the next poll to notice. Given the
+    name of a SharedFrame (and the event which tells the output process about each state), states are published there
+    for the output process to send instead. Publishing doesn't count as a send, so then the output timings are only
+    kept by the output process.
+    """
+    if frameName is not None:
+        processor = BackgroundProcessor(send=SharedFrame(frameName, published).write)
+    else:
+        processor = BackgroundProcessor()
+    processor.checkTables()
+    dumpMetricsOnSignal(processor.metrics)
+    print("Background processing started...")
+
+    # Main background processing loop.
+    while True:
+        woken = waitForWakeup(wakeup, processor.timeUntilNextEvent(time()))
+        processor.step(time(), woken)
+
+
+def outputProcessing(frameName, published):
+    """
+    Sends each state the background processing publishes to the SharedFrame on to the cRIO as soon as it's published,
+    so the frames keep the background processing's timing. This is all the output process does, so a database stall in
+    the background processing can't hold up a frame: meanwhile our own frame clock keeps sending the cRIO the last
+    state as a keepalive, until the background processing publishes the next one.
+    """
+    frame = SharedFrame(frameName, published)
+    frameClock = FrameClock(constants.FRAME_RATE)
+    sender = FrameSender(constants.CRIO_ADDRESS, constants.KEEPALIVE_INTERVAL, monotonic, frameClock.period / 2)
+    sender.precompile(defaultPattern)
+    nextReport = monotonic() + constants.FRAME_REPORT_INTERVAL
+    metrics = OutputMetrics()
+    dumpMetricsOnSignal(metrics)
+    lastSequence = frame.sequence  # Whatever is there already, if anything, was decided before we started.
+    print("Output processing started...")
+
+    while True:
+        # Clear the event before reading, so a state published while we're sending this one wakes us up again.
+        if published.wait(max(frameClock.untilNextFrame(), 0)):
+            published.clear()
+        elif frameClock.tick() is None:
+            continue
+        else:
+            metrics.overrun.record(frameClock.lastLateness)
+
+        # The latency runs from when the background processing worked the state out, but only the first send of each
+        # published state has one - after that we're resending it as a keepalive.
+        state, decided, sequence = frame.read()
+        if sender.send(state):
+            metrics.sent(monotonic(), decided if sequence != lastSequence else None)
+        lastSequence = sequence
+
+        if monotonic() >= nextReport:
+            print("Output frame clock: " + frameClock.report())
+            nextReport += constants.FRAME_REPORT_INTERVAL
 
 
 # The backend is threaded - one thread (which we will start and spin off) takes care of the API hook
 # and associated interaction, while the main thread then proceeds to run periodic tasks (like updating the running
-# pattern, clearing old control queues, sending events to the cRIO).
+# pattern, clearing old control queues, sending events to the cRIO). The two share an event which the API uses to wake
+# the background processing up as soon as something changes.
 
 if __name__ == '__main__':
     print("Enlight backend version " + constants.VERSION)
 
+    # Set by the API process whenever control requests, releases or valve writes come in.
+    wakeup = Event()
+
     print("Spawning API hook process...")
-    p = Process(target=startAPI)
+    p = Process(target=startAPI, args=(wakeup,))
     p.start()
 
+    # In the frames output mode, frames can be sent from a process of their own, which the background processing hands
+    # its states to through shared memory. (Streamed timelines are played on the cRIO's clock, so don't need this.)
+    frame = None
+    published = None
+    if constants.OUTPUT_PROCESS and constants.OUTPUT_MODE == "frames":
+        published = Event()
+        frame = SharedFrame()
+        print('Starting output processing...')
+        o = Process(target=outputProcessing, args=(frame.name, published))
+        o.start()
+
     print('Starting background processing...')
-    p = Process(target=backgroundProcessing)
-    p.start()
\ No newline at end of file
+    p = Process(target=backgroundProcessing, args=(wakeup, frame.name if frame is not None else None, published))
+    p.start()
+
+    if frame is not None:
+        p.join()
+        o.terminate()
+        frame.close()
+        frame.unlink()
@@ -0,0 +1,104 @@
+# ###
+# Benchmarks the background processing's tick latency. Each run builds a fresh database with some amount of history
+# (expired control requests), a queue of live requests spread over some number of priority levels, and then steps a
+# BackgroundProcessor through a simulated clock, with a new control request coming in on every tick.
+#
+# Usage: python bench.py [ticks per run]
+# ###
+import contextlib
+import io
+import os
+import sys
+import tempfile
+from time import perf_counter
+
+import constants
+import fountain
+import queries
+from backend import BackgroundProcessor
+
+SIZES = [10, 100, 1000, 10000, 100000]
+
+
+class ManualClock:
+    """A clock which only moves when told to, standing in for both the wall clock and the monotonic clock."""
+
+    def __init__(self, now):
+        self.now = now
+
+    def time(self):
+        return self.now
+
+    def advance(self, seconds):
+        self.now += seconds
+
+
+def populate(history, depth, priorities):
+    """Fills the database with expired history and a live queue of pending requests over the given priority levels."""
+    con = fountain.db_connect()
+    c = con.cursor()
+    c.executemany("INSERT INTO controlQueue (priority, acquire, ttl, queuePosition, apikey) VALUES (?, 0, 0, -2, ?)",
+                  [(10 * (1 + i % priorities), 'abc123') for i in range(history)])
+    c.executemany(queries.REQUEST_CONTROL,
+                  [{'priority': 10 * (1 + i % priorities), 'ttl': 30, 'apikey': 'abc123'} for i in range(depth)])
+    fountain.db_close(con)
+
+
+def run(history, depth, priorities, ticks):
+    """Returns the sorted per-tick latencies (in seconds) for one configuration."""
+    directory = tempfile.mkdtemp()
+    constants.DB_FILENAME = os.path.join(directory, 'bench.sqlite')
+    latencies = []
+
+    with contextlib.redirect_stdout(io.StringIO()):
+        fountain.db_createTables()
+        fountain.db_loadDefaults()
+        populate(history, depth, priorities)
+
+        clock = ManualClock(1000000000.0)
+        processor = BackgroundProcessor(clock=clock.time, monotonicClock=clock.time, send=lambda state: None)
+        processor.nextArchive = float('inf')  # Keep the history in place, it's what we're measuring against.
+
+        # The first tick loads and schedules the whole queue, which only happens at startup.
+        processor.step(clock.time(), True)
+
+        for i in range(ticks):
+            con = fountain.db_connect()
+            con.execute(queries.REQUEST_CONTROL,
+                        {'priority': 10 * (1 + i % priorities), 'ttl': 30, 'apikey': 'abc123'})
+            fountain.db_close(con)
+
+            clock.advance(processor.frameClock.period)
+            start = perf_counter()
+            processor.step(clock.time(), True)
+            latencies.append(perf_counter() - start)
+
+        processor.disconnect()
+
+    for name in os.listdir(directory):
+        os.remove(os.path.join(directory, name))
+    os.rmdir(directory)
+
+    return sorted(latencies)
+
+
+def report(history, depth, priorities, ticks):
+    latencies = run(history, depth, priorities, ticks)
+    median = latencies[len(latencies) // 2]
+    p99 = latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+    # Only as many priority levels as there are live requests can actually be in use.
+    print("%8d %8d %10d %12.1f %12.1f %12.1f" % (history, depth, min(depth, priorities), median * 1e6, p99 * 1e6,
+                                                 latencies[-1] * 1e6))
+
+
+if __name__ == '__main__':
+    ticks = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+
+    print("%8s %8s %10s %12s %12s %12s" % ('history', 'depth', 'priorities', 'median us', 'p99 us', 'max us'))
+    for size in SIZES:
+        report(size, 10, 3, ticks)
+    for size in SIZES:
+        report(1000, size, 3, ticks)
+    # Enough live requests that every priority level has at least one.
+    for size in SIZES:
+        report(1000, max(1000, size), size, ticks)
@@ -1,3 +1,65 @@
+import os
+
 VERSION = "0.0.1"
 DB_FILENAME = "maquina.sqlite"
+DB_BUSY_TIMEOUT = 5.0  # Seconds the background processing waits on a locked database before giving up.
 NUM_VALVES = 24
+
+# How long (in seconds) the background processing waits for a wakeup from the API before polling the database anyway.
+# The API wakes it up for every change it makes, so this is only the fallback for changes made behind its back.
+POLL_INTERVAL = 5.0
+
+# How many frames per second (1 to 50 Hz) the background processing sends to the fountain, and how long (in seconds)
+# each step of the default pattern is shown for, whatever the frame rate.
+FRAME_RATE = 1.0
+DEFAULT_PATTERN_STEP = 1.0
+
+# How often (in seconds) the background processing prints the frame clock's overrun and skipped frame counts.
+FRAME_REPORT_INTERVAL = 60.0
+
+# Retention of released and expired control requests. Every ARCHIVE_INTERVAL seconds, up to ARCHIVE_BATCH_SIZE of them
+# are moved from the controlQueue to the controlQueueArchive table. Archived requests are deleted once they are older
+# than ARCHIVE_MAX_AGE seconds, or once there are more than ARCHIVE_MAX_ROWS of them. Either limit can be None to keep
+# archived requests forever.
+ARCHIVE_INTERVAL = 5.0
+ARCHIVE_BATCH_SIZE = 100
+ARCHIVE_MAX_AGE = 30 * 24 * 60 * 60
+ARCHIVE_MAX_ROWS = 100000
+
+# Fair queueing among API keys with the same priority. When enabled, one key flooding the queue with requests only
+# pushes back its own requests instead of everyone else's. Keys can be given a larger share with a weight (default 1).
+FAIR_QUEUEING = False
+FAIR_QUEUEING_WEIGHTS = {}
+
+# Early release of abandoned and idle controllers. A controller which has sent a heartbeat has to keep sending them, and
+# loses control LEASE_TIMEOUT seconds after its last one. Any controller loses control after IDLE_TIMEOUT seconds
+# without a valve write. Either can be None to turn it off.
+LEASE_TIMEOUT = 10.0
+IDLE_TIMEOUT = 60.0
+
+# Priority aging. A waiting request's priority goes up by AGING_RATE for every second it waits, so that low priority
+# requests can't be starved forever: at 0.1, a priority 10 request which has waited 200 seconds is next in line ahead of
+# freshly made priority 30 ones. None serves strictly by priority.
+AGING_RATE = None
+
+# Where the cRIO which drives the fountain listens for frames, and how often (in seconds) an unchanged state is sent to
+# it again. Changed states are always sent straight away. Set ENLIGHT_CRIO_HOST and ENLIGHT_CRIO_PORT to send the frames
+# somewhere else, like to simulator.py.
+CRIO_ADDRESS = (os.environ.get("ENLIGHT_CRIO_HOST", "128.104.196.80"), int(os.environ.get("ENLIGHT_CRIO_PORT", 30096)))
+KEEPALIVE_INTERVAL = 1.0
+
+# How frames get to the cRIO. "frames" sends each frame as it comes due. "timeline" streams the next TIMELINE_HORIZON
+# seconds of frames ahead of time for the receiver to play on its own clock, so that our timing doesn't matter.
+OUTPUT_MODE = "frames"
+TIMELINE_HORIZON = 2.0
+
+# Whether frames are sent from a separate output process, which the background processing hands states to through
+# shared memory, so that database stalls don't delay frames. Only used in the "frames" output mode.
+OUTPUT_PROCESS = False
+
+# How much memory (in bytes) the background processing may keep compiled patterns in, so that engaging a pattern which
+# has played before doesn't compile it again.
+PATTERN_CACHE_BYTES = 64 * 1024 * 1024
+
+# The largest request body (in bytes) the API accepts, which limits the size of uploaded patterns.
+MAX_REQUEST_SIZE = 32 * 1024 * 1024
@@ -1,6 +1,7 @@
 # #####
 # Internal functions to the fountain. Most of these get called by the API in some way.
 # ########
+import re
 import sqlite3
 import queries
 import constants
@@ -9,6 +10,18 @@ def db_connect():
     """Opens a connection to the database and returns the connection object."""
     return sqlite3.connect(constants.DB_FILENAME)
 
+def db_connectBackground():
+    """
+    Opens the long-lived connection used by the background processing. WAL lets the API keep reading while we write,
+    and with synchronous=NORMAL a commit doesn't wait on an fsync. The busy timeout makes us wait for API writers rather
+    than failing straight away.
+    """
+    con = sqlite3.connect(constants.DB_FILENAME, timeout=constants.DB_BUSY_TIMEOUT)
+    con.execute('PRAGMA journal_mode=WAL')
+    con.execute('PRAGMA synchronous=NORMAL')
+    con.execute('PRAGMA temp_store=MEMORY')
+    return con
+
 def db_close(con):
     """Closes any open connection to the database."""
     # I guess every connection with the DB-API 2.0 bindings is treated like a transaction, so commit it.
@@ -25,6 +38,204 @@ def db_createTables():
     c.execute(queries.CREATE_TABLE_PATTERNS)
     c.execute(queries.CREATE_TABLE_VALVES)
     db_close(con)
+    db_migrate()
+
+def db_migrate():
+    """Brings the schema of an existing database up to date. Safe to run on every start."""
+    con = db_connect()
+    c = con.cursor()
+    columns = [row[1] for row in c.execute(queries.QUERY_CONTROLQUEUE_COLUMNS).fetchall()]
+    if 'heartbeat' not in columns:
+        c.execute(queries.ADD_CONTROLQUEUE_HEARTBEAT)
+    if 'activity' not in columns:
+        c.execute(queries.ADD_CONTROLQUEUE_ACTIVITY)
+
+    c.execute(queries.CREATE_INDEX_CONTROLQUEUE_PRIORITY_POSITION)
+    c.execute(queries.CREATE_INDEX_CONTROLQUEUE_POSITION_PRIORITY)
+    c.execute(queries.CREATE_INDEX_CONTROLQUEUE_TTL_POSITION)
+    c.execute(queries.CREATE_TABLE_CONTROLQUEUE_ARCHIVE)
+    c.execute(queries.CREATE_INDEX_CONTROLQUEUE_ARCHIVE_ARCHIVED)
+    c.execute(queries.CREATE_INDEX_PATTERNDATA_PATTERN_TIME)
+
+    columns = [row[1] for row in c.execute(queries.QUERY_PATTERNS_COLUMNS).fetchall()]
+    if 'version' not in columns:
+        c.execute(queries.ADD_PATTERNS_VERSION)
+    if 'file' not in columns:
+        c.execute(queries.ADD_PATTERNS_FILE)
+    if 'fileVersion' not in columns:
+        c.execute(queries.ADD_PATTERNS_FILE_VERSION)
+    if 'runs' not in columns:
+        c.execute(queries.ADD_PATTERNS_RUNS)
+    c.execute(queries.CREATE_TRIGGER_PATTERNDATA_INSERT)
+    c.execute(queries.CREATE_TRIGGER_PATTERNDATA_UPDATE)
+    c.execute(queries.CREATE_TRIGGER_PATTERNDATA_DELETE)
+    c.execute(queries.CREATE_TRIGGER_PATTERNS_RUNS)
+
+    c.execute(queries.CREATE_TABLE_CONTROLQUEUE_VERSION)
+    c.execute(queries.INSERT_CONTROLQUEUE_VERSION)
+    c.execute(queries.CREATE_TRIGGER_CONTROLQUEUE_VERSION)
+    db_close(con)
+
+def db_readLiveControlQueue(con):
+    """Reads the already scheduled control requests, for rebuilding the scheduler's in-memory queue."""
+    c = con.cursor()
+    c.execute(queries.GET_LIVE_CONTROL_QUEUE)
+    return c.fetchall()
+
+def db_readValveState(con):
+    """Reads the current valve states as a bitmask, with valve 1 in the lowest bit."""
+    state = 0
+    idx = 0
+    for row in con.execute(queries.QUERY_VALVES).fetchall():
+        # TODO: Might need to make sure the valves in this bitmask correspond to what the cRIO knows.
+        state |= int(row[3]) << idx
+        idx += 1
+    return state
+
+def db_readControlLiveness(con, controllerID):
+    """Reads the (heartbeat, activity) times of a controller, either of which is -1 if it has never happened."""
+    c = con.cursor()
+    c.execute(queries.GET_CONTROL_LIVENESS, {'controllerID': controllerID})
+    r = c.fetchone()
+    if r is None:
+        return -1, -1
+    return r
+
+def db_readActivePattern(con):
+    """
+    Reads the (ID, version, file, encoded) of the engaged pattern, or (None, None, None, False) if no (enabled) pattern
+    is engaged. The file is None unless the pattern was imported from a pattern file, and hasn't been changed since.
+    Encoded says whether the pattern is stored as runs rather than in patternData.
+    """
+    r = con.execute(queries.GET_ACTIVE_PATTERN).fetchone()
+    if r is None:
+        return None, None, None, False
+    return r[0], r[1], r[2], bool(r[3])
+
+def db_readPatternRuns(con, patternID):
+    """Reads a pattern's encoded runs, or None if it's stored in patternData."""
+    r = con.execute(queries.GET_PATTERN_RUNS, {'id': patternID}).fetchone()
+    if r is None:
+        return None
+    return r[0]
+
+def db_readPatternEvents(con, patternID):
+    """Reads a pattern's (time, valve, action) events, sorted by time."""
+    return con.execute(queries.GET_PATTERN_EVENTS, {'id': patternID}).fetchall()
+
+def db_createPattern(name, description, events=(), runs=None, file=None):
+    """
+    Creates a pattern, either from its encoded runs or from its (time, valve, action) events, all in one transaction so
+    that the background processing never sees it half written, and returns its ID. Raises sqlite3.IntegrityError if
+    the name is already taken. A pattern imported from a pattern file is given the file's path, to play it from.
+    """
+    con = db_connect()
+    try:
+        c = con.cursor()
+        c.execute(queries.CREATE_PATTERN, {'name': name, 'description': description, 'runs': runs})
+        patternID = c.lastrowid
+        c.executemany(queries.ADD_PATTERN_EVENT, [(patternID, time, valve, action) for time, valve, action in events])
+        if file is not None:
+            c.execute(queries.SET_PATTERN_FILE, {'id': patternID, 'file': file})
+        con.commit()
+    except sqlite3.Error:
+        con.rollback()
+        raise
+    finally:
+        con.close()
+
+    return patternID
+
+def db_readControlChanges(con):
+    """
+    Reads what changed in the control queue since the last tick - the pending requests as (controllerID, priority, ttl,
+    apikey) rows, and the controllerIDs of released requests. Both are read in one transaction so they come from the
+    same snapshot.
+    """
+    c = con.cursor()
+    c.execute('BEGIN')
+    c.execute(queries.FIND_PENDING_CONTROL_REQUESTS)
+    pending = c.fetchall()
+    c.execute(queries.FIND_RELEASED_CONTROL_REQUESTS)
+    released = [row[0] for row in c.fetchall()]
+    con.commit()
+
+    return pending, released
+
+def db_applyTransitions(con, transitions):
+    """
+    Writes the scheduler's transitions back in a single batch. BEGIN IMMEDIATE takes the write lock up front, so the
+    lock is held only for this one executemany and not across the reads and decisions which led up to it.
+    """
+    if not transitions:
+        return
+
+    c = con.cursor()
+    c.execute('BEGIN IMMEDIATE')
+    c.executemany(queries.SET_QUEUE_POSITION_AND_ACQUIRE, transitions)
+    con.commit()
+
+def db_archiveControlQueue(con, now):
+    """
+    Runs one bounded pass of the control queue retention job: moves up to ARCHIVE_BATCH_SIZE expired requests into the
+    archive, then prunes up to that many archived requests by age and by count. Returns True if there was more work than
+    fit in the batch, so the caller can come back for more soon.
+    """
+    batch = constants.ARCHIVE_BATCH_SIZE
+    c = con.cursor()
+    c.execute('BEGIN IMMEDIATE')
+
+    c.execute(queries.FIND_EXPIRED_CONTROL_REQUESTS, {'batch': batch})
+    expired = [{'controllerID': row[0], 'archived': int(now)} for row in c.fetchall()]
+    c.executemany(queries.ARCHIVE_CONTROL_REQUEST, expired)
+    c.executemany(queries.DELETE_CONTROL_REQUEST, expired)
+    moreToDo = len(expired) == batch
+
+    if constants.ARCHIVE_MAX_AGE is not None:
+        c.execute(queries.PRUNE_ARCHIVE_BY_AGE, {'cutoff': int(now) - constants.ARCHIVE_MAX_AGE, 'batch': batch})
+        moreToDo = moreToDo or c.rowcount == batch
+
+    if constants.ARCHIVE_MAX_ROWS is not None:
+        c.execute(queries.COUNT_ARCHIVE)
+        excess = c.fetchone()[0] - constants.ARCHIVE_MAX_ROWS
+        if excess > 0:
+            c.execute(queries.PRUNE_ARCHIVE_OLDEST, {'batch': min(excess, batch)})
+            moreToDo = moreToDo or excess > batch
+
+    con.commit()
+    return moreToDo
+
+def db_checkQueryPlans():
+    """
+    Runs EXPLAIN QUERY PLAN over every single statement query in queries.py, other than the queries.ALLOWED_SCANS, and
+    returns a list of (name, plan detail) for every one that falls back to scanning a whole table, which usually means
+    an index is missing.
+    """
+    con = db_connect()
+    c = con.cursor()
+    scans = []
+
+    for name in sorted(vars(queries)):
+        query = getattr(queries, name)
+        if not name.isupper() or not isinstance(query, str) or name in queries.ALLOWED_SCANS:
+            continue
+        # Only statements which read or write rows have a plan. Scripts of several statements, like the defaults, are
+        # only ever run by hand.
+        if query.split()[0].upper() not in ('SELECT', 'INSERT', 'UPDATE', 'DELETE') or ';' in query.strip(' \n;'):
+            continue
+
+        # The plan doesn't depend on the parameter values, so just bind all of the parameters to NULL.
+        if ':' in query:
+            params = dict((p, None) for p in re.findall(r':(\w+)', query))
+        else:
+            params = [None] * query.count('?')
+
+        for row in c.execute('EXPLAIN QUERY PLAN ' + query, params).fetchall():
+            if row[3].startswith('SCAN'):
+                scans.append((name, row[3]))
+
+    db_close(con)
+    return scans
     
 def db_dropTables():
     """Drops all the known tables in the database, useful for debugging."""
@@ -32,6 +243,8 @@ def db_dropTables():
     c = con.cursor()
     c.execute(queries.DROP_TABLE_APIKEYS)
     c.execute(queries.DROP_TABLE_CONTROLQUEUE)
+    c.execute(queries.DROP_TABLE_CONTROLQUEUE_ARCHIVE)
+    c.execute(queries.DROP_TABLE_CONTROLQUEUE_VERSION)
     c.execute(queries.DROP_TABLE_PATTERNDATA)
     c.execute(queries.DROP_TABLE_PATTERNS)
     c.execute(queries.DROP_TABLE_VALVES)
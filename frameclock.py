@@ -0,0 +1,86 @@
+# ###
+# The fixed-rate frame clock which paces the background processing.
+# ###
+from time import monotonic
+
+
+class FrameClock:
+    """
+    Hands out frames at a fixed rate on the monotonic clock. Frame n is due at start + n * period however long the work
+    for the earlier frames took, so the tempo never drifts. If we fall a whole period or more behind, the frames we
+    missed are skipped (and counted) instead of being played late, so a slow tick can't stretch the show.
+    """
+
+    # A frame which starts more than this fraction of a period late counts as an overrun.
+    OVERRUN_TOLERANCE = 0.25
+
+    # The frame rates (in Hz) the cRIO can keep up with.
+    MIN_RATE = 1
+    MAX_RATE = 50
+
+    def __init__(self, rate, clock=monotonic):
+        if not self.MIN_RATE <= rate <= self.MAX_RATE:
+            raise ValueError("Frame rate must be " + str(self.MIN_RATE) + " to " + str(self.MAX_RATE) + " Hz, got " +
+                             str(rate))
+
+        self.rate = rate
+        self.period = 1.0 / rate
+        self.clock = clock
+        self.start = clock()
+        self.frame = 0  # The index of the next frame which is due.
+        self.lastLateness = 0.0  # How late the last frame claimed by tick() was.
+        self.behind = False  # Whether the last frame claimed by tick() skipped any, so we only say so once.
+
+        # Statistics since the last report().
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.worstLateness = 0.0
+
+    def nextFrameAt(self):
+        """Returns the time (on this clock) at which the next frame is due."""
+        return self.start + self.frame * self.period
+
+    def untilNextFrame(self):
+        """Returns how many seconds are left until the next frame is due. Negative if it's already late."""
+        return self.nextFrameAt() - self.clock()
+
+    def tick(self):
+        """
+        Claims the frame which is due now and returns its index, or returns None if no frame is due yet. Frames which we
+        are at least a whole period late for are skipped over.
+        """
+        lateness = self.clock() - self.nextFrameAt()
+        if lateness < 0:
+            return None
+
+        missed = int(lateness // self.period)
+        if missed > 0:
+            self.skipped += missed
+            # Say so when we first fall behind. While we stay behind the skipped frames are only counted, for report().
+            if not self.behind:
+                print("Frame clock is " + str(int(lateness * 1000)) + " ms behind, skipping " + str(missed) +
+                      " frames.")
+        self.behind = missed > 0
+
+        if lateness > self.period * self.OVERRUN_TOLERANCE:
+            self.overruns += 1
+        self.worstLateness = max(self.worstLateness, lateness)
+        self.lastLateness = lateness
+
+        self.frame += missed
+        frame = self.frame
+        self.frame += 1
+        self.frames += 1
+        return frame
+
+    def report(self):
+        """Returns a summary of the timing since the last report, and starts counting afresh."""
+        summary = (str(self.frames) + " frames at " + str(self.rate) + " Hz, " + str(self.overruns) + " overruns, " +
+                   str(self.skipped) + " skipped, worst lateness " + str(round(self.worstLateness * 1000, 1)) + " ms")
+
+        self.frames = 0
+        self.overruns = 0
+        self.skipped = 0
+        self.worstLateness = 0.0
+        return summary
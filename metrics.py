@@ -0,0 +1,91 @@
+# ###
+# Timing instrumentation for the output: how regularly frames leave, how late ticks start, and how long a state takes
+# from being worked out to being sent.
+# ###
+from array import array
+
+
+class Histogram:
+    """
+    A histogram of values (in seconds, kept as whole microseconds) with a fixed number of log-linear buckets, in the
+    style of HdrHistogram: every value up to maxValue is counted to within about 1 part in 2 ** (subBucketBits - 1),
+    however small or large it is, while the memory used stays fixed however many values are recorded. Larger values
+    are counted as maxValue.
+    """
+
+    def __init__(self, maxValue=60.0, subBucketBits=8):
+        self.subBucketBits = subBucketBits
+        self.subBucketHalf = 1 << (subBucketBits - 1)
+        self.maxValue = int(maxValue * 1000000)
+        self.counts = array('Q', [0]) * (self.index(self.maxValue) + 1)
+        self.total = 0
+        self.min = None
+        self.max = None
+
+    def index(self, value):
+        """Returns the bucket for a value in microseconds: its power of two, and where it sits within it."""
+        exponent = max(0, value.bit_length() - self.subBucketBits)
+        return exponent * self.subBucketHalf + (value >> exponent)
+
+    def lowestValue(self, index):
+        """The inverse of index(), returning the smallest value in microseconds which falls in the bucket."""
+        exponent = max(0, index // self.subBucketHalf - 1)
+        return (index - exponent * self.subBucketHalf) << exponent
+
+    def record(self, seconds):
+        value = min(max(0, int(seconds * 1000000)), self.maxValue)
+        self.counts[self.index(value)] += 1
+        self.total += 1
+        self.min = value if self.min is None else min(self.min, value)
+        self.max = value if self.max is None else max(self.max, value)
+
+    def percentile(self, percentile):
+        """Returns the value (in seconds) which the given percentage of the recorded values are at or below."""
+        if self.total == 0:
+            return None
+
+        wanted = max(1, int(round(self.total * percentile / 100.0)))
+        seen = 0
+        for i, count in enumerate(self.counts):
+            seen += count
+            if seen >= wanted:
+                return min(max(self.lowestValue(i), self.min), self.max) / 1000000.0
+        return self.max / 1000000.0
+
+    def summary(self):
+        if self.total == 0:
+            return "no values"
+
+        return (str(self.total) + " values, min " + ms(self.min / 1000000.0) + ", " +
+                ", ".join("p" + str(p) + " " + ms(self.percentile(p)) for p in (50, 90, 99, 99.9)) +
+                ", max " + ms(self.max / 1000000.0))
+
+
+class OutputMetrics:
+    """The output timing histograms of one process. Kept since it started, and dumped on demand with report()."""
+
+    def __init__(self):
+        self.interval = Histogram()  # Between one frame (or chunk) being sent and the next.
+        self.overrun = Histogram()  # How late a tick started after its frame was due.
+        self.latency = Histogram()  # From a state being worked out to it having been sent.
+        self.lastSent = None
+
+    def sent(self, now, decided=None):
+        """
+        Records a send which finished at now, of a state which was worked out at decided. Resends of a state which has
+        already been sent, like keepalives, have no decided time, and only count towards the send interval.
+        """
+        if self.lastSent is not None:
+            self.interval.record(now - self.lastSent)
+        self.lastSent = now
+        if decided is not None:
+            self.latency.record(now - decided)
+
+    def report(self):
+        return "\n".join(["Send interval: " + self.interval.summary(),
+                          "Tick overrun: " + self.overrun.summary(),
+                          "Decided to sent latency: " + self.latency.summary()])
+
+
+def ms(seconds):
+    return str(round(seconds * 1000, 3)) + " ms"
@@ -0,0 +1,225 @@
+# ###
+# Output of valve states to the cRIO which drives the fountain.
+# ###
+import socket
+import struct
+from multiprocessing import shared_memory
+from time import monotonic
+
+
+# A frame is the opcode byte, followed by the horizontal and then the vertical valves, big endian.
+OPCODE_FRAME = 0x01
+FRAME = struct.Struct(">BHH")
+
+
+def splitState(state):
+    """Splits a valve state bitmask into the (horizontals, verticals) words the cRIO expects."""
+    horizontals = (((state >> 20) & 15) << 8) | ((state >> 12) & 255)
+    verticals = (((state >> 8) & 15) << 8) | (state & 255)
+    return horizontals, verticals
+
+
+def joinState(horizontals, verticals):
+    """The inverse of splitState(), for decoding frames back into a valve state bitmask."""
+    return (((horizontals >> 8) & 15) << 20) | ((horizontals & 255) << 12) | (((verticals >> 8) & 15) << 8) | \
+        (verticals & 255)
+
+
+def encodeState(state):
+    """Encodes a valve state bitmask as an opcode 0x01 frame."""
+    horizontals, verticals = splitState(state)
+    return FRAME.pack(OPCODE_FRAME, horizontals, verticals)
+
+
+def compilePayloads(states):
+    """Encodes every state of a pattern up front, returning a table of {state: frame} ready to be sent as is."""
+    return dict((state, encodeState(state)) for state in states)
+
+
+class FrameSender:
+    """
+    Sends valve states to the cRIO over a single connected UDP socket, which stays open for the life of the process. A
+    state goes out as soon as it changes. An unchanged state is only sent again once every keepalive seconds, so the
+    cRIO still hears from us regularly without us making a syscall on every tick. As the ticks which send keepalives
+    wake up a little early or late, a keepalive is sent up to tolerance seconds early - usually half a frame period -
+    so that a tick landing just short of the keepalive doesn't hold it back a whole frame.
+
+    States of precompiled patterns are sent straight from a table of ready made frames. Any other state is packed into
+    a buffer which is reused for every frame, so sending doesn't allocate a new payload either way.
+    """
+
+    def __init__(self, address, keepalive, clock=monotonic, tolerance=0):
+        self.keepalive = keepalive - tolerance
+        self.clock = clock
+        self.lastState = None
+        self.lastSent = None
+        self.payloads = {}
+        self.buffer = bytearray(FRAME.size)
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP socket
+        self.sock.connect(address)
+
+    def precompile(self, states):
+        """Adds the frames for a pattern's states to the table of ready made frames."""
+        self.payloads.update(compilePayloads(states))
+
+    def send(self, state):
+        """Sends the state if it has changed or the keepalive is due. Returns True if it was sent."""
+        now = self.clock()
+        if state == self.lastState and now - self.lastSent < self.keepalive:
+            return False
+
+        payload = self.payloads.get(state)
+        if payload is None:
+            horizontals, verticals = splitState(state)
+            FRAME.pack_into(self.buffer, 0, OPCODE_FRAME, horizontals, verticals)
+            payload = self.buffer
+
+        try:
+            self.sock.send(payload)
+        except OSError as e:
+            # A connected UDP socket reports ICMP errors from earlier sends, e.g. while the cRIO is down. Carry on, the
+            # next state or keepalive will try again.
+            print("Failed to send to the cRIO: " + str(e))
+            return False
+
+        self.lastState = state
+        self.lastSent = now
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+# A timeline chunk is the opcode byte, the index of its first frame, the frame period in microseconds and the number of
+# frames, followed by the (horizontals, verticals) of each frame in turn. Frame n plays at n periods after the stream's
+# first frame, on the receiver's own clock, and a chunk replaces everything the receiver had from its first frame on.
+OPCODE_TIMELINE = 0x02
+TIMELINE_HEADER = struct.Struct(">BIIH")
+TIMELINE_FRAME = struct.Struct(">HH")
+
+# Keeps a whole chunk within a single unfragmented UDP datagram.
+MAX_TIMELINE_FRAMES = 340
+
+
+def encodeTimeline(firstFrame, period, states):
+    """Encodes the states of consecutive frames, starting at frame index firstFrame, as an opcode 0x02 chunk."""
+    payload = bytearray(TIMELINE_HEADER.size + TIMELINE_FRAME.size * len(states))
+    TIMELINE_HEADER.pack_into(payload, 0, OPCODE_TIMELINE, firstFrame, int(round(period * 1000000)), len(states))
+
+    offset = TIMELINE_HEADER.size
+    for state in states:
+        TIMELINE_FRAME.pack_into(payload, offset, *splitState(state))
+        offset += TIMELINE_FRAME.size
+    return payload
+
+
+def decodeTimeline(payload):
+    """The inverse of encodeTimeline(). Returns (firstFrame, period, states)."""
+    opcode, firstFrame, period, count = TIMELINE_HEADER.unpack_from(payload, 0)
+    states = [joinState(horizontals, verticals)
+              for horizontals, verticals in TIMELINE_FRAME.iter_unpack(payload[TIMELINE_HEADER.size:])]
+    return firstFrame, period / 1000000.0, states[:count]
+
+
+class TimelineSender:
+    """
+    Streams the fountain's upcoming frames to the receiver ahead of time, so that it can play them on its own clock and
+    the backend being late for a frame (a slow tick, a database lock, a GC pause) doesn't show in the water.
+
+    Every frame we're told what the next horizon seconds of frames should be, as far as we know now. Nothing is sent as
+    long as that agrees with what the receiver already has, and it has at least half the horizon left to play. Otherwise
+    - when somebody takes control or changes the valves, or the receiver is running low - a chunk starting at the
+    current frame goes out, replacing the receiver's future. The refill every half horizon doubles as the keepalive.
+    """
+
+    def __init__(self, address, period, horizon):
+        self.period = period
+        self.frames = max(1, min(MAX_TIMELINE_FRAMES, int(round(horizon / period))))
+        self.firstFrame = None  # The index of the first frame of the last chunk we sent...
+        self.streamed = []  # ...and its states.
+
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)  # UDP socket
+        self.sock.connect(address)
+
+    def stream(self, frame, states):
+        """
+        Brings the receiver up to date with states, the states of frames frame, frame + 1 and so on, if they differ
+        from what it has or it's running low. Returns True if a chunk was sent.
+        """
+        states = states[:self.frames]
+        if self.firstFrame is not None:
+            offset = frame - self.firstFrame
+            left = len(self.streamed) - offset
+            if offset >= 0 and left * 2 >= self.frames and self.streamed[offset:offset + len(states)] == states[:left]:
+                return False
+
+        try:
+            self.sock.send(encodeTimeline(frame, self.period, states))
+        except OSError as e:
+            # As with FrameSender, carry on and try again next frame.
+            print("Failed to send to the cRIO: " + str(e))
+            return False
+
+        self.firstFrame = frame
+        self.streamed = states
+        return True
+
+    def close(self):
+        self.sock.close()
+
+
+class SharedFrame:
+    """
+    The current valve state, shared between the background processing (the writer) and the output process (the reader)
+    through a double buffer in shared memory: a sequence number followed by two slots, each holding a state and the
+    time it was worked out, on the monotonic clock which every process shares. The writer fills the slot the
+    reader isn't looking at and then bumps the sequence number to point at it. The reader takes the slot the sequence
+    number points at, and tries again if the number changed while it was reading, so it never sees a half written state.
+    Neither side ever waits on the other. The writer also sets the published event, if it's given one, after each state
+    it publishes, so the reader can send the state on as soon as it's there instead of on a clock of its own.
+    """
+
+    def __init__(self, name=None, published=None, clock=monotonic):
+        if name is None:
+            self.shm = shared_memory.SharedMemory(create=True, size=32)
+        else:
+            self.shm = shared_memory.SharedMemory(name=name)
+        self.name = self.shm.name
+        self.published = published
+        self.clock = clock
+        self.words = self.shm.buf[:16].cast('I')  # [sequence, slot 0 state, slot 1 state, unused]
+        self.times = self.shm.buf[16:32].cast('d')  # [slot 0 decided, slot 1 decided]
+        self.sequence = self.words[0]
+
+    def write(self, state):
+        """
+        Publishes a new state, which was worked out just now. Only the one writing process may call this. Returns False,
+        to stand in for a send: nothing has been sent yet, the output process sends it and keeps the timings of that.
+        """
+        sequence = (self.sequence + 1) & 0xFFFFFFFF
+        self.words[1 + (sequence & 1)] = state
+        self.times[sequence & 1] = self.clock()
+        self.words[0] = sequence
+        self.sequence = sequence
+        if self.published is not None:
+            self.published.set()
+        return False
+
+    def read(self):
+        """Returns the latest published state, when it was worked out, and its sequence number."""
+        while True:
+            sequence = self.words[0]
+            state = self.words[1 + (sequence & 1)]
+            decided = self.times[sequence & 1]
+            if self.words[0] == sequence:
+                return state, decided, sequence
+
+    def close(self):
+        self.words.release()
+        self.times.release()
+        self.shm.close()
+
+    def unlink(self):
+        """Frees the shared memory for good, once every process is done with it."""
+        self.shm.unlink()
@@ -0,0 +1,259 @@
+# ###
+# A compact binary format for long patterns, which the pattern engine plays straight out of a memory map. Uploaded
+# patterns are stored in the same format, in the runs column of the patterns table, and played from there.
+#
+# The file is a header followed by the pattern's runs - stretches of frames with the same valve state - as two columns:
+# the frame each run starts on, and its state. All fields are little endian:
+#
+#   magic       4 bytes   b'ENLP'
+#   version     uint16    1
+#   valves      uint16    number of valves in each state (NUM_VALVES)
+#   frameLength uint32    milliseconds per frame
+#   frameCount  uint32    frames in the pattern, after which it loops
+#   runCount    uint32    runs in the pattern
+#   starts      uint32 x runCount, ascending from 0
+#   states      uint32 x runCount
+#
+# Every field is a 32 bit word past the header so that the columns can be viewed in place, without copying them out of
+# the map. An hour of a pattern which changes once a second takes about 28 KB, however short its frames are.
+#
+# A pattern file which may be playing must never be edited or truncated in place: the pattern engine has it mapped, and
+# reading a page of the map which is no longer in the file kills the process with a SIGBUS. Pattern files are always
+# written to a new file next to the old one and renamed over it instead, so a playing pattern keeps its old copy.
+#
+# Usage: python patternfile.py export <patternID> <file> [frameLength]
+#        python patternfile.py import <file> <name> [description]
+# Importing adds the pattern to the patterns table, and remembers the file so the pattern engine plays from it.
+# ###
+import math
+import mmap
+import os
+import struct
+import sys
+import tempfile
+from array import array
+from bisect import bisect_right
+
+import constants
+import fountain
+from patterns import compileEvents
+
+MAGIC = b'ENLP'
+FORMAT_VERSION = 1
+HEADER = struct.Struct("<4sHHIII")
+
+
+class PatternRuns:
+    """
+    A pattern's runs, read in place from a buffer in the pattern file format - so a frame's state is only decoded when
+    it's played. stateAt() finds a frame's run by bisecting the starts column, but as playback moves through the frames
+    in order it remembers the run it's in, and almost always finds the frame still in it, or in the next.
+    """
+
+    def __init__(self, buffer, name):
+        try:
+            self.view = memoryview(buffer)
+            if len(self.view) < HEADER.size:
+                raise ValueError(name + " is not a pattern.")
+            magic, version, valves, self.frameLength, self.frameCount, runCount = HEADER.unpack_from(self.view, 0)
+            if magic != MAGIC or version != FORMAT_VERSION:
+                raise ValueError(name + " is not a version " + str(FORMAT_VERSION) + " pattern.")
+            if valves != constants.NUM_VALVES:
+                raise ValueError(name + " is for " + str(valves) + " valves, not " + str(constants.NUM_VALVES) + ".")
+            if len(self.view) != HEADER.size + 8 * runCount or runCount == 0 or self.frameLength == 0:
+                raise ValueError(name + " is truncated or corrupt.")
+
+            self.starts = self.columnView(HEADER.size, runCount)
+            self.states = self.columnView(HEADER.size + 4 * runCount, runCount)
+            if self.starts[0] != 0 or self.starts[-1] >= self.frameCount:
+                raise ValueError(name + " has runs outside of its frames.")
+        except ValueError:
+            PatternRuns.close(self)
+            raise
+
+        self.findRun(0)
+
+    def columnView(self, offset, count):
+        """Views a column of uint32s in place - or, on a big endian machine, has to copy and swap them after all."""
+        if sys.byteorder == 'little':
+            return self.view[offset:offset + 4 * count].cast('I')
+
+        column = array('I', self.view[offset:offset + 4 * count])
+        column.byteswap()
+        return column
+
+    def stateAt(self, frame):
+        """Returns the state of a frame of the pattern, looping past its end."""
+        if self.runStart <= frame < self.runEnd:
+            return self.runState
+
+        frame %= self.frameCount
+        if not self.runStart <= frame < self.runEnd:
+            run = self.run + 1
+            if not (run < len(self.starts) and self.starts[run] <= frame and
+                    (run + 1 == len(self.starts) or frame < self.starts[run + 1])):
+                run = bisect_right(self.starts, frame) - 1
+            self.findRun(run)
+        return self.runState
+
+    def findRun(self, run):
+        """Remembers the frames [runStart, runEnd) which run covers, and its state."""
+        self.run = run
+        self.runStart = self.starts[run]
+        self.runEnd = self.starts[run + 1] if run + 1 < len(self.starts) else self.frameCount
+        self.runState = self.states[run]
+
+    def close(self):
+        for name in ('starts', 'states', 'view'):
+            view = getattr(self, name, None)
+            if isinstance(view, memoryview):
+                view.release()
+
+
+class PatternFile(PatternRuns):
+    """A pattern file, memory mapped."""
+
+    def __init__(self, path):
+        with open(path, 'rb') as f:
+            self.map = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        try:
+            PatternRuns.__init__(self, self.map, path)
+        except ValueError:
+            self.map.close()
+            raise
+
+    def close(self):
+        PatternRuns.close(self)
+        self.map.close()
+
+
+class FileTimeline:
+    """
+    Presents PatternRuns as a timeline for the pattern engine, with one state per frame of the background processing,
+    whatever the runs' frame length. As with compiled patterns, a frame plays the state as of its end, so that it shows
+    any change which happens during it.
+    """
+
+    def __init__(self, runs, period):
+        self.runs = runs
+        self.scale = period * 1000.0 / runs.frameLength
+        self.frames = max(1, int(math.ceil(runs.frameCount / self.scale - 1e-9)))
+
+        # Usually each of our frames is a whole number of the runs' frames, which saves some floating point per frame.
+        self.step = int(round(self.scale)) if abs(self.scale - round(self.scale)) < 1e-9 else None
+
+    def __len__(self):
+        return self.frames
+
+    def __getitem__(self, frame):
+        if self.step is not None:
+            last = (frame + 1) * self.step - 1
+        else:
+            last = int(math.ceil((frame + 1) * self.scale - 1e-9)) - 1
+        return self.runs.stateAt(min(last, self.runs.frameCount - 1))
+
+
+def encodeRuns(frameLength, frameCount, starts, states):
+    """Encodes a pattern's runs, as array('I') columns, in the pattern file format."""
+    if sys.byteorder != 'little':
+        starts = array('I', starts)
+        states = array('I', states)
+        starts.byteswap()
+        states.byteswap()
+
+    header = HEADER.pack(MAGIC, FORMAT_VERSION, constants.NUM_VALVES, frameLength, frameCount, len(starts))
+    return header + starts.tobytes() + states.tobytes()
+
+
+def encodeFrames(frameLength, frames):
+    """Encodes the states of a pattern's frames, each frameLength milliseconds long, in the pattern file format."""
+    starts = array('I')
+    states = array('I')
+    for i, state in enumerate(frames):
+        if not states or states[-1] != state:
+            starts.append(i)
+            states.append(state)
+
+    return encodeRuns(frameLength, len(frames), starts, states)
+
+
+def encodeEvents(events):
+    """
+    Encodes a pattern's (time, valve, action) events, sorted by time, in the pattern file format. The frames are a
+    millisecond long, and the pattern ends with the millisecond of its last event, just as compileEvents() has it.
+    """
+    starts = array('I', [0])
+    states = array('I', [0])
+    state = 0
+    for time, valve, action in events:
+        if action:
+            state |= 1 << (valve - 1)
+        else:
+            state &= ~(1 << (valve - 1))
+
+        if starts[-1] == time:
+            states[-1] = state
+        elif states[-1] != state:
+            starts.append(time)
+            states.append(state)
+
+    return encodeRuns(1, events[-1][0] + 1, starts, states)
+
+
+def replaceFile(path, data):
+    """Writes data to a new file and renames it over path, so that nothing mapping the old file ever sees it change."""
+    fd, temporary = tempfile.mkstemp(dir=os.path.dirname(os.path.abspath(path)), prefix=".pattern-")
+    try:
+        with os.fdopen(fd, 'wb') as f:
+            os.fchmod(f.fileno(), 0o644)  # mkstemp() makes files only we can read.
+            f.write(data)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(temporary, path)
+    except BaseException:
+        os.unlink(temporary)
+        raise
+
+
+def writePatternFile(path, frameLength, frames):
+    """Writes the states of a pattern's frames, each frameLength milliseconds long, to a pattern file."""
+    replaceFile(path, encodeFrames(frameLength, frames))
+
+
+def exportPattern(patternID, path, frameLength):
+    """
+    Writes a pattern from the patterns tables to a pattern file. Patterns which are stored encoded are written out as
+    they are, others are compiled with frames frameLength milliseconds long.
+    """
+    con = fountain.db_connect()
+    runs = fountain.db_readPatternRuns(con, patternID)
+    events = fountain.db_readPatternEvents(con, patternID) if runs is None else None
+    fountain.db_close(con)
+
+    if runs is not None:
+        replaceFile(path, runs)
+    else:
+        writePatternFile(path, frameLength, compileEvents(events, frameLength / 1000.0))
+
+
+def importPattern(path, name, description=None):
+    """Adds the pattern in a pattern file to the patterns table, to be played from the file. Returns its ID."""
+    patternFile = PatternFile(path)
+    try:
+        runs = bytes(patternFile.view)
+    finally:
+        patternFile.close()
+
+    return fountain.db_createPattern(name, description, runs=runs, file=os.path.abspath(path))
+
+
+if __name__ == '__main__':
+    if len(sys.argv) >= 4 and sys.argv[1] == 'export':
+        exportPattern(int(sys.argv[2]), sys.argv[3], int(sys.argv[4]) if len(sys.argv) > 4 else 50)
+    elif len(sys.argv) >= 4 and sys.argv[1] == 'import':
+        print("Imported as pattern " + str(importPattern(sys.argv[2], sys.argv[3],
+                                                         sys.argv[4] if len(sys.argv) > 4 else None)))
+    else:
+        print("Usage: python patternfile.py export <patternID> <file> [frameLength]")
+        print("       python patternfile.py import <file> <name> [description]")
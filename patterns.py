@@ -0,0 +1,141 @@
+# ###
+# The pattern engine. A pattern is compiled once, when it's engaged, into a timeline: an array('I') holding the valve
+# state bitmask of every frame of the pattern, so that playing it is just an index into the array each frame. Patterns
+# stored encoded as runs are played straight from those instead (see patternfile.py).
+# ###
+from array import array
+from collections import OrderedDict
+
+import constants
+
+# Encoded patterns (see patternfile.py) keep times and frame lengths in uint32 fields, and a pattern's frame count is
+# one more than the time of its last event.
+MAX_EVENT_TIME = 0xFFFFFFFE
+MAX_FRAME_LENGTH = 0xFFFFFFFF
+
+
+def frameOf(time, period):
+    """Returns the index of the frame which a pattern event at time (in milliseconds) falls in."""
+    return int(time / 1000.0 / period + 1e-9)
+
+
+def compileEvents(events, period):
+    """
+    Compiles a pattern's (time, valve, action) events, sorted by time, into a timeline of one state per frame. An event
+    takes effect from the frame its time falls in; an action of 0 turns the valve off, and anything else turns it on.
+    The pattern ends with the frame of its last event, after which it loops.
+    """
+    if not events:
+        raise ValueError("Pattern has no events.")
+
+    timeline = array('I', [0]) * (frameOf(events[-1][0], period) + 1)
+    state = 0
+    frame = 0
+    for time, valve, action in events:
+        if valve < 1 or valve > constants.NUM_VALVES:
+            raise ValueError("Pattern event at " + str(time) + " ms is for an unknown valve " + str(valve) + ".")
+
+        # Every frame up to this event's plays the state as it was before it.
+        eventFrame = frameOf(time, period)
+        while frame < eventFrame:
+            timeline[frame] = state
+            frame += 1
+
+        if action:
+            state |= 1 << (valve - 1)
+        else:
+            state &= ~(1 << (valve - 1))
+
+    timeline[frame] = state
+    return timeline
+
+
+def compileSteps(states, stepLength, period):
+    """Compiles a list of states, each shown for stepLength seconds, into a timeline of one state per frame."""
+    frames = max(1, int(round(len(states) * stepLength / period)))
+    return array('I', [states[int(f * period / stepLength) % len(states)] for f in range(frames)])
+
+
+def checkEvents(events):
+    """
+    Checks uploaded (time, valve, action) events, returning them as a list of integer tuples sorted by time. Raises a
+    ValueError describing the first bad event.
+    """
+    checked = []
+    for event in events:
+        if not isinstance(event, (list, tuple)) or len(event) != 3:
+            raise ValueError("Events must be [time, valve, action], got " + repr(event) + ".")
+
+        time, valve, action = event
+        if not all(isinstance(value, int) and not isinstance(value, bool) for value in event):
+            raise ValueError("Event " + repr(event) + " must be whole numbers.")
+        if time < 0:
+            raise ValueError("Event " + repr(event) + " has a negative time.")
+        if time > MAX_EVENT_TIME:
+            raise ValueError("Event " + repr(event) + " is later than " + str(MAX_EVENT_TIME) + " ms.")
+        if valve < 1 or valve > constants.NUM_VALVES:
+            raise ValueError("Event " + repr(event) + " is for an unknown valve.")
+        if action not in (0, 1):
+            raise ValueError("Event " + repr(event) + " has an action other than 0 (off) or 1 (on).")
+        checked.append((time, valve, action))
+
+    if not checked:
+        raise ValueError("A pattern needs at least one event.")
+
+    # sort() is stable, so events at the same time keep their order.
+    checked.sort(key=lambda event: event[0])
+    return checked
+
+
+def checkFrames(frames, frameLength):
+    """
+    Checks uploaded frames - one valve state bitmask every frameLength milliseconds. Raises a ValueError describing the
+    first bad frame.
+    """
+    if not isinstance(frameLength, int) or isinstance(frameLength, bool) or frameLength <= 0:
+        raise ValueError("frameLength must be a positive whole number of milliseconds.")
+    if frameLength > MAX_FRAME_LENGTH:
+        raise ValueError("frameLength must be at most " + str(MAX_FRAME_LENGTH) + " ms.")
+    if not isinstance(frames, list) or not frames:
+        raise ValueError("A pattern needs at least one frame.")
+
+    for i, state in enumerate(frames):
+        if not isinstance(state, int) or isinstance(state, bool) or state < 0 or state >> constants.NUM_VALVES:
+            raise ValueError("Frame " + str(i) + " is not a bitmask of " + str(constants.NUM_VALVES) + " valves.")
+
+
+class PatternCache:
+    """
+    The compiled timelines of recently played patterns, keyed by (pattern ID, version), so engaging a pattern we've
+    played before doesn't compile it again. A pattern's version goes up whenever its data changes, so an edited pattern
+    simply misses the cache, and its stale timelines are dropped as soon as the new one is added. Least recently used
+    timelines are evicted once they take up more than maxBytes between them.
+    """
+
+    def __init__(self, maxBytes):
+        self.maxBytes = maxBytes
+        self.bytes = 0
+        self.timelines = OrderedDict()
+
+    def get(self, patternID, version):
+        """Returns the cached timeline of a pattern at a version, or None."""
+        key = (patternID, version)
+        timeline = self.timelines.get(key)
+        if timeline is not None:
+            self.timelines.move_to_end(key)
+        return timeline
+
+    def put(self, patternID, version, timeline):
+        for key in [key for key in self.timelines if key[0] == patternID]:
+            self.remove(key)
+
+        self.timelines[(patternID, version)] = timeline
+        self.bytes += timeline.itemsize * len(timeline)
+
+        # Always keep the one just added, even if it's bigger than the whole cache.
+        while self.bytes > self.maxBytes and len(self.timelines) > 1:
+            self.remove(next(iter(self.timelines)))
+
+    def remove(self, key):
+        timeline = self.timelines.pop(key)
+        self.bytes -= timeline.itemsize * len(timeline)
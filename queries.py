@@ -26,7 +26,9 @@ CREATE_TABLE_APIKEYS = """
 # represents this unique instance of fountain control (unique for a while, at
 # least). Aquired and expires timestamps determine a period of control, and a
 # numeric priority field determines who should be in control. Queue positions
-# are tracked here as well.
+# are tracked here as well, and so are the times of the controller's last
+# heartbeat and last valve write (-1 if there hasn't been one), which decide
+# when an idle or abandoned controller loses control early.
 CREATE_TABLE_CONTROLQUEUE = """
     CREATE TABLE IF NOT EXISTS controlQueue (
         controllerID INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -34,10 +36,145 @@ CREATE_TABLE_CONTROLQUEUE = """
         ttl INTEGER NOT NULL,
         priority INTEGER NOT NULL,
         queuePosition INTEGER NOT NULL,
-        apikey REFERENCES apikeys (apikey)
+        apikey REFERENCES apikeys (apikey),
+        heartbeat REAL DEFAULT -1 NOT NULL,
+        activity REAL DEFAULT -1 NOT NULL
     )
 """
 
+# Adds the heartbeat and activity columns to a controlQueue created before they existed.
+QUERY_CONTROLQUEUE_COLUMNS = """
+    PRAGMA table_info(controlQueue)
+"""
+
+ADD_CONTROLQUEUE_HEARTBEAT = """
+    ALTER TABLE controlQueue ADD COLUMN heartbeat REAL DEFAULT -1 NOT NULL
+"""
+
+ADD_CONTROLQUEUE_ACTIVITY = """
+    ALTER TABLE controlQueue ADD COLUMN activity REAL DEFAULT -1 NOT NULL
+"""
+
+# Released and expired control requests are moved out of the controlQueue into this archive by the background
+# processing, so that the live table stays at the size of the active queue. Besides the controlQueue columns, each row
+# remembers when it was archived, which the retention job uses to prune the archive by age.
+CREATE_TABLE_CONTROLQUEUE_ARCHIVE = """
+    CREATE TABLE IF NOT EXISTS controlQueueArchive (
+        controllerID INTEGER PRIMARY KEY,
+        acquire INTEGER NOT NULL,
+        ttl INTEGER NOT NULL,
+        priority INTEGER NOT NULL,
+        queuePosition INTEGER NOT NULL,
+        apikey REFERENCES apikeys (apikey),
+        archived INTEGER NOT NULL
+    )
+"""
+
+CREATE_INDEX_CONTROLQUEUE_ARCHIVE_ARCHIVED = """
+    CREATE INDEX IF NOT EXISTS controlQueueArchiveArchived
+    ON controlQueueArchive (archived)
+"""
+
+# Indexes for the controlQueue. The background scheduling queries all filter on queuePosition (pending, live or expired)
+# and priority, and released requests are found by their TTL, so without these every tick would scan the whole history
+# of the table. They are created with IF NOT EXISTS so that fountain.db_migrate() can add them to existing databases.
+CREATE_INDEX_CONTROLQUEUE_PRIORITY_POSITION = """
+    CREATE INDEX IF NOT EXISTS controlQueuePriorityPosition
+    ON controlQueue (priority, queuePosition)
+"""
+
+CREATE_INDEX_CONTROLQUEUE_POSITION_PRIORITY = """
+    CREATE INDEX IF NOT EXISTS controlQueuePositionPriority
+    ON controlQueue (queuePosition, priority)
+"""
+
+CREATE_INDEX_CONTROLQUEUE_TTL_POSITION = """
+    CREATE INDEX IF NOT EXISTS controlQueueTtlPosition
+    ON controlQueue (ttl, queuePosition)
+"""
+
+# Adds the version, file and runs columns to a patterns table created before they existed.
+QUERY_PATTERNS_COLUMNS = """
+    PRAGMA table_info(patterns)
+"""
+
+ADD_PATTERNS_VERSION = """
+    ALTER TABLE patterns ADD COLUMN version INTEGER DEFAULT 0 NOT NULL
+"""
+
+ADD_PATTERNS_FILE = """
+    ALTER TABLE patterns ADD COLUMN file TEXT
+"""
+
+ADD_PATTERNS_FILE_VERSION = """
+    ALTER TABLE patterns ADD COLUMN fileVersion INTEGER
+"""
+
+ADD_PATTERNS_RUNS = """
+    ALTER TABLE patterns ADD COLUMN runs BLOB
+"""
+
+# Any change to a pattern's data bumps its version, which is what the background processing's cache of compiled
+# patterns is keyed on - so however the data is changed, a stale compiled pattern is never played.
+CREATE_TRIGGER_PATTERNDATA_INSERT = """
+    CREATE TRIGGER IF NOT EXISTS patternDataInsertVersion AFTER INSERT ON patternData
+    BEGIN
+        UPDATE patterns SET version=version + 1 WHERE ID=NEW.patternID;
+    END
+"""
+
+CREATE_TRIGGER_PATTERNDATA_UPDATE = """
+    CREATE TRIGGER IF NOT EXISTS patternDataUpdateVersion AFTER UPDATE ON patternData
+    BEGIN
+        UPDATE patterns SET version=version + 1 WHERE ID=OLD.patternID OR ID=NEW.patternID;
+    END
+"""
+
+CREATE_TRIGGER_PATTERNDATA_DELETE = """
+    CREATE TRIGGER IF NOT EXISTS patternDataDeleteVersion AFTER DELETE ON patternData
+    BEGIN
+        UPDATE patterns SET version=version + 1 WHERE ID=OLD.patternID;
+    END
+"""
+
+CREATE_TRIGGER_PATTERNS_RUNS = """
+    CREATE TRIGGER IF NOT EXISTS patternsRunsVersion AFTER UPDATE OF runs ON patterns
+    BEGIN
+        UPDATE patterns SET version=version + 1 WHERE ID=NEW.ID;
+    END
+"""
+
+# A counter which goes up whenever a request's place in the live control queue changes - it's scheduled, acquires
+# control, is released or expires - but not on heartbeats, valve writes or anything else. The API only rebuilds its
+# index of the queue when this changes (see api.getQueueIndex()).
+CREATE_TABLE_CONTROLQUEUE_VERSION = """
+    CREATE TABLE IF NOT EXISTS controlQueueVersion (
+        ID INTEGER PRIMARY KEY CHECK (ID=0),
+        version INTEGER NOT NULL
+    )
+"""
+
+INSERT_CONTROLQUEUE_VERSION = """
+    INSERT OR IGNORE INTO controlQueueVersion (ID, version) VALUES (0, 0)
+"""
+
+CREATE_TRIGGER_CONTROLQUEUE_VERSION = """
+    CREATE TRIGGER IF NOT EXISTS controlQueueVersionUpdate AFTER UPDATE OF queuePosition, acquire, ttl ON controlQueue
+    BEGIN
+        UPDATE controlQueueVersion SET version=version + 1 WHERE ID=0;
+    END
+"""
+
+QUERY_CONTROLQUEUE_VERSION = """
+    SELECT version FROM controlQueueVersion WHERE ID=0
+"""
+
+# The pattern engine reads a pattern's events in time order when it's engaged.
+CREATE_INDEX_PATTERNDATA_PATTERN_TIME = """
+    CREATE INDEX IF NOT EXISTS patternDataPatternTime
+    ON patternData (patternID, time)
+"""
+
 # A table of valves which describe the interactive elements of the fountain.
 # Each valve has a numeric ID, a name, a description, and boolean enabled and
 # spraying states.
@@ -52,22 +189,31 @@ CREATE_TABLE_VALVES = """
 """
 
 # A table of patterns which are sequences of on/off triggers for valves. Each
-# pattern consists of an ID, a name, a description, an active field, and an
-# enabled field.
+# pattern consists of an ID, a name, a description, an active field, an
+# enabled field, a version which goes up whenever its pattern data changes, and
+# optionally the pattern file it was imported from (see patternfile.py) along
+# with the version it was imported as. Once the data has been changed since, the
+# file is out of date, and is ignored. Uploaded and imported patterns keep their
+# data encoded as runs (in the pattern file format), instead of in patternData.
 CREATE_TABLE_PATTERNS = """
     CREATE TABLE IF NOT EXISTS patterns (
         ID INTEGER PRIMARY KEY,
         name TEXT UNIQUE NOT NULL,
         description TEXT,
         active INTEGER NOT NULL,
-        enabled INTEGER DEFAULT 1 NOT NULL
+        enabled INTEGER DEFAULT 1 NOT NULL,
+        version INTEGER DEFAULT 0 NOT NULL,
+        file TEXT,
+        fileVersion INTEGER,
+        runs BLOB
     )
 """
 
 # A table of pattern data. Each pattern has associated with it a series of
 # actions, represented here. A single entry represents one action. An action
-# has a pattern ID reference, an activation time (since the start of pattern),
-# a valve to action, and an action to take.
+# has a pattern ID reference, an activation time (in milliseconds since the
+# start of pattern), a valve to action, and an action to take (0 for off, 1 for
+# on).
 CREATE_TABLE_PATTERNDATA = """
     CREATE TABLE IF NOT EXISTS patternData (
         patternID REFERENCES patterns(ID),
@@ -165,6 +311,14 @@ DROP_TABLE_CONTROLQUEUE = """
     DROP TABLE IF EXISTS controlQueue
 """
 
+DROP_TABLE_CONTROLQUEUE_ARCHIVE = """
+    DROP TABLE IF EXISTS controlQueueArchive
+"""
+
+DROP_TABLE_CONTROLQUEUE_VERSION = """
+    DROP TABLE IF EXISTS controlQueueVersion
+"""
+
 DROP_TABLE_VALVES = """
     DROP TABLE IF EXISTS valves
 """
@@ -221,6 +375,20 @@ RELEASE_CONTROL = """
     WHERE controllerID=:controllerID
 """
 
+# Renews a controller's lease. Once a controller has sent a heartbeat, it has to keep sending them to keep control.
+HEARTBEAT_CONTROL = """
+    UPDATE controlQueue
+    SET heartbeat=:now
+    WHERE controllerID=:controllerID AND queuePosition > -2
+"""
+
+# Records that a controller has just done something with the fountain, so it isn't idle.
+TOUCH_CONTROL_ACTIVITY = """
+    UPDATE controlQueue
+    SET activity=:now
+    WHERE controllerID=:controllerID AND queuePosition > -2
+"""
+
 
 # Get a list of the valves and their states.
 QUERY_VALVES = """
@@ -250,6 +418,32 @@ ENGAGE_PATTERN = """
     WHERE ID=:id and enabled<>0
 """
 
+# Creates a new, disengaged pattern, with its encoded runs. A pattern without runs has its events added with
+# ADD_PATTERN_EVENT instead.
+CREATE_PATTERN = """
+    INSERT INTO patterns (name, description, active, runs)
+    VALUES (:name, :description, 0, :runs)
+"""
+
+ADD_PATTERN_EVENT = """
+    INSERT INTO patternData (patternID, time, valve, action)
+    VALUES (?, ?, ?, ?)
+"""
+
+# Records the pattern file a pattern was imported from, once its events have all been added.
+SET_PATTERN_FILE = """
+    UPDATE patterns
+    SET file=:file, fileVersion=version
+    WHERE ID=:id
+"""
+
+# Disengages every pattern but the one just engaged, as only one can play at a time.
+DISENGAGE_OTHER_PATTERNS = """
+    UPDATE patterns
+    SET active=0
+    WHERE ID<>:id AND active<>0
+"""
+
 # Updates the spraying status of a particular valve.
 SET_VALVE = """
     UPDATE valves
@@ -266,62 +460,139 @@ CHECK_IF_CONTROL_QUEUE_EXISTS = """
     SELECT COUNT(*) FROM sqlite_master WHERE type='table' AND name='controlQueue'
 """
 
+# Changes whenever another connection commits to the database, which lets the API tell cheaply whether anything it has
+# cached from the database may be out of date.
+QUERY_DATA_VERSION = """
+    PRAGMA data_version
+"""
+
+# Loads the control requests which are already scheduled, so the background scheduler can rebuild its in-memory queue
+# and the API can index the queue.
+GET_LIVE_CONTROL_QUEUE = """
+    SELECT controllerID, acquire, ttl, priority, queuePosition, apikey
+    FROM controlQueue
+    WHERE queuePosition > -1
+"""
+
 # Discover requests that have been made, but not yet sorted into the control queue.
 FIND_PENDING_CONTROL_REQUESTS = """
-    SELECT controllerID, priority
+    SELECT controllerID, priority, ttl, apikey
     FROM controlQueue
     WHERE queuePosition = -1
+    ORDER BY controllerID ASC
 """
 
-# Discover the current maximum position among active records in the controlQueue of a certain priority. Needs to be
-# where queuePosition > -2 because we don't want to look at expired records.
-FIND_MAX_QUEUE_POSITION_FOR_PRIORITY = """
-    SELECT MAX(queuePosition)
+# Discover scheduled requests whose owners have released control (their TTL has been set to 0), but which the
+# scheduler hasn't dropped from the queue yet.
+FIND_RELEASED_CONTROL_REQUESTS = """
+    SELECT controllerID
     FROM controlQueue
-    WHERE priority=:priority AND queuePosition > -2
+    WHERE ttl = 0 AND queuePosition > -2
 """
 
-# Updates a control request's queue position. (Like scheduling it from -1 to an actual position.)
-SET_QUEUE_POSITION = """
+# Writes back a control request's queue position and acquire time, as decided by the background scheduler.
+SET_QUEUE_POSITION_AND_ACQUIRE = """
     UPDATE controlQueue
-    SET queuePosition=:queuePosition
+    SET queuePosition=:queuePosition, acquire=:acquire
     WHERE controllerID=:controllerID
 """
 
-# Updates a controllerID by setting its acquired time.
-SET_CONTROL_ACQUIRED_TIME_TO_NOW = """
-    UPDATE controlQueue
-    SET acquire=strftime('%s','now')
+# Finds the engaged pattern, its version, its pattern file and whether it's encoded, for the pattern engine to play when
+# nobody is in control. Only one should be engaged, but if there's more than one, the latest pattern wins.
+GET_ACTIVE_PATTERN = """
+    SELECT ID, version, CASE WHEN fileVersion=version THEN file END, runs IS NOT NULL
+    FROM patterns
+    WHERE active<>0 AND enabled<>0
+    ORDER BY ID DESC
+    LIMIT 1
+"""
+
+# Reads a pattern's encoded runs, for playing it.
+GET_PATTERN_RUNS = """
+    SELECT runs
+    FROM patterns
+    WHERE ID=:id
+"""
+
+# Reads the events of a pattern in the order they happen, for compiling it.
+GET_PATTERN_EVENTS = """
+    SELECT time, valve, action
+    FROM patternData
+    WHERE patternID=:id
+    ORDER BY time ASC, rowid ASC
+"""
+
+# Gets the times of a controller's last heartbeat and last valve write, to see whether it should keep control.
+GET_CONTROL_LIVENESS = """
+    SELECT heartbeat, activity
+    FROM controlQueue
     WHERE controllerID=:controllerID
 """
 
-# Used for finding the top queue which should be served.
-FIND_MAX_PRIORITY_IN_QUEUE = """
-    SELECT MAX(priority)
+# ###
+# Control queue retention. Expired requests (queuePosition of -2) are moved to the archive a bounded batch at a time,
+# and the archive itself is pruned by age and by row count, again in bounded batches.
+# ###
+
+FIND_EXPIRED_CONTROL_REQUESTS = """
+    SELECT controllerID
     FROM controlQueue
-    WHERE queuePosition > -2
+    WHERE queuePosition = -2
+    LIMIT :batch
 """
 
-# Get a list of controllerIDs waiting in a certain priority queue, in the order that they should be served.
-GET_QUEUE_AT_PRIORITY = """
-    SELECT acquire, ttl, queuePosition, controllerID
+ARCHIVE_CONTROL_REQUEST = """
+    INSERT OR REPLACE INTO controlQueueArchive (controllerID, acquire, ttl, priority, queuePosition, apikey, archived)
+    SELECT controllerID, acquire, ttl, priority, queuePosition, apikey, :archived
     FROM controlQueue
-    WHERE queuePosition > -2 AND priority=:priority
-    ORDER BY queuePosition ASC
+    WHERE controllerID=:controllerID
 """
 
+DELETE_CONTROL_REQUEST = """
+    DELETE FROM controlQueue
+    WHERE controllerID=:controllerID
+"""
 
-GET_PRIORITY_LEVELS = """
-    SELECT priority
-    FROM controlQueue
-    WHERE queuePosition > -1
-    GROUP BY priority
-    ORDER BY priority DESC
+PRUNE_ARCHIVE_BY_AGE = """
+    DELETE FROM controlQueueArchive
+    WHERE controllerID IN (
+        SELECT controllerID
+        FROM controlQueueArchive
+        WHERE archived < :cutoff
+        LIMIT :batch
+    )
 """
 
+COUNT_ARCHIVE = """
+    SELECT COUNT(*) FROM controlQueueArchive
+"""
 
-CHECK_IF_IM_IN_THE_QUEUE = """
-    SELECT COUNT(*)
-    FROM controlQueue
-    WHERE controllerID=:controllerID AND queuePosition > -1
-"""
\ No newline at end of file
+# Removes the oldest archived requests. controllerIDs are AUTOINCREMENT, so they are never reused and their order is
+# the order the requests were made in.
+PRUNE_ARCHIVE_OLDEST = """
+    DELETE FROM controlQueueArchive
+    WHERE controllerID IN (
+        SELECT controllerID
+        FROM controlQueueArchive
+        ORDER BY controllerID ASC
+        LIMIT :batch
+    )
+"""
+
+# ######################################################################################################################
+# Query plan checks.
+# ######################################################################################################################
+
+# fountain.db_checkQueryPlans() verifies at startup - and test_queryplans.py whenever the tests are run - that none of
+# the queries above has to scan a whole table, as the hot ones run on every tick of the background processing or on
+# every API request. These few are allowed to, each for the reason given.
+ALLOWED_SCANS = [
+    'CHECK_IF_CONTROL_QUEUE_EXISTS',  # Only runs at startup, on SQLite's own tiny catalog.
+    'QUERY_CONTROL_QUEUE',  # Lists the whole queue on purpose. The retention job keeps it to recent requests.
+    'QUERY_VALVES',  # Lists the whole valves table on purpose, which is one row per valve.
+    'QUERY_PATTERNS',  # Lists every pattern on purpose.
+    'GET_ACTIVE_PATTERN',  # One row per pattern, and only read when the API wakes us up or a poll is due.
+    'DISENGAGE_OTHER_PATTERNS',  # One row per pattern, and only when a pattern is engaged.
+    'COUNT_ARCHIVE',  # Counts through the archive's smallest index, once per retention job run.
+    'PRUNE_ARCHIVE_OLDEST',  # Walks the archive in controllerID order, stopping after a batch of rows.
+]
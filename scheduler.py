@@ -0,0 +1,397 @@
+# ###
+# The control queue scheduler. The background process keeps the live (not yet expired) part of the controlQueue table
+# in memory here, and the database only acts as a write-behind persistence layer for it.
+# ###
+import heapq
+
+
+class ControlRequest:
+    """A single live entry in the control queue."""
+    __slots__ = ('controllerID', 'priority', 'queuePosition', 'acquire', 'ttl', 'apikey', 'enqueued')
+
+    def __init__(self, controllerID, priority, queuePosition, acquire, ttl, apikey, enqueued):
+        self.controllerID = controllerID
+        self.priority = priority
+        self.queuePosition = queuePosition
+        self.acquire = acquire
+        self.ttl = ttl
+        self.apikey = apikey
+        self.enqueued = enqueued
+
+
+class ControlScheduler:
+    """
+    Holds the live control queue keyed by (priority, queuePosition). Each priority level has its own heap of controllers
+    ordered by queue position, and a heap of the priority levels finds the level which should be served. Stale heap
+    items are dropped lazily, so enqueueing, promoting, expiring and releasing a controller are all O(log n) regardless
+    of how much history the controlQueue table holds.
+
+    A queue position of 0 means that the controller has (or had, if it was preempted by a higher priority) control.
+    Waiting controllers are numbered from 1 upwards within their priority level, and expired ones get position -2.
+
+    By default each priority level is strictly first come, first served. In fair mode, waiting controllers are instead
+    ordered by a virtual finish time, as in weighted fair queueing: each API key's requests finish one after the other
+    in virtual time, each taking its TTL divided by the key's weight, and a level's virtual time moves on to the finish
+    time of whoever it last served. A key which floods the queue only pushes its own later requests back, while another
+    key's first request slots in right behind the one being served. The finish time is used as the queue position, so
+    the heaps (and everything reading queue positions from the database) work just the same.
+
+    With an aging rate, a waiting controller's effective priority grows by that much for every second it has waited, so
+    a steady stream of high priority requests can't starve the lower priority levels forever. A higher priority request
+    still takes control straight away from a lower priority controller, but whenever control is up for grabs it goes to
+    whichever level's first waiting controller has the highest effective priority - a controller which was preempted
+    stops aging, so it mustn't hold back the ones behind it. Only the first one or two controllers of each level are
+    ever looked at, so this costs O(levels) per decision rather than a rescan of the queue.
+    """
+
+    def __init__(self, fair=False, weights=None, agingRate=None):
+        self.fair = fair
+        self.weights = weights if weights is not None else {}  # apikey -> weight, 1 if not listed.
+        self.agingRate = agingRate  # Priority gained per second of waiting, None to serve strictly by priority.
+        self.longestWaits = {}  # priority -> longest wait of anyone who got control since the last waitMetrics().
+        self.entries = {}  # controllerID -> ControlRequest, only live (queuePosition >= 0) entries.
+        self.queues = {}  # priority -> heap of (queuePosition, controllerID).
+        self.counts = {}  # priority -> number of live entries at that priority.
+        self.levels = []  # Heap of negated priorities, so the highest priority is at the top.
+        self.levelsInHeap = set()
+        self.nextQueuePosition = {}  # priority -> the position the next request at that priority will get.
+        self.dirty = {}  # controllerID -> (queuePosition, acquire) which still needs to be written to the database.
+        self.deadlines = []  # Heap of (acquire + ttl, controllerID) for the controllers which have acquired control.
+        self.controlledBy = -1
+
+        # Fair mode only: priority -> the level's virtual time, and priority -> {apikey: virtual finish time}.
+        self.virtualTime = {}
+        self.finishTimes = {}
+
+    def load(self, rows, now):
+        """
+        Loads already scheduled rows of (controllerID, acquire, ttl, priority, queuePosition, apikey) from the database.
+        Their waits are counted from now, as the database doesn't know when they were made.
+        """
+        for row in rows:
+            self._insert(ControlRequest(row[0], row[3], row[4], row[1], row[2], row[5], now))
+
+        # We don't know what the virtual times were before a restart, so carry on from just before the first waiting
+        # request in each level. Each key's finish time is that of its last waiting request, as its queue positions are
+        # its finish times, so a key's next request still goes in behind its own.
+        if self.fair:
+            for priority, heap in self.queues.items():
+                waiting = [position for position, controllerID in heap if position > 0]
+                self.virtualTime[priority] = min(waiting) - 1 if waiting else 0
+            for entry in self.entries.values():
+                finishTimes = self.finishTimes.setdefault(entry.priority, {})
+                finishTimes[entry.apikey] = max(finishTimes.get(entry.apikey, 0), entry.queuePosition)
+
+    def decide(self, pending, released, now):
+        """
+        Works out all of one tick's transitions from a snapshot of what changed in the database since the last one: the
+        pending (controllerID, priority, ttl, apikey) rows and the released controllerIDs. Doesn't touch the database
+        at all. Returns the controllerID in control (or -1), and the transitions as SET_QUEUE_POSITION_AND_ACQUIRE
+        parameters.
+        """
+        # One line for all of a tick's new requests, however many flood in at once.
+        queued = []
+        for controllerID, priority, ttl, apikey in pending:
+            position = self.enqueue(controllerID, priority, ttl, apikey, now)
+            queued.append('cID ' + str(controllerID) + ' as position ' + str(position) + ' in priority ' +
+                          str(priority))
+        if len(queued) > 5:
+            queued[5:] = [str(len(queued) - 5) + ' more']
+        if queued:
+            print('Queueing ' + ', '.join(queued) + '.')
+
+        for controllerID in released:
+            self.release(controllerID)
+
+        controlledBy = self.advance(now)
+        return controlledBy, self.takeDirty()
+
+    def enqueue(self, controllerID, priority, ttl, apikey, now):
+        """
+        Schedules a pending control request in its priority queue and returns its queue position. That's the back of
+        the queue, unless we're in fair mode.
+        """
+        if self.fair:
+            finishTimes = self.finishTimes.setdefault(priority, {})
+            start = max(self.virtualTime.get(priority, 0), finishTimes.get(apikey, 0))
+            position = start + max(1, int(ttl / self.weights.get(apikey, 1)))
+            finishTimes[apikey] = position
+        else:
+            position = self.nextQueuePosition.get(priority, 1)
+
+        self._insert(ControlRequest(controllerID, priority, position, -1, ttl, apikey, now))
+        self._markDirty(controllerID, position, -1)
+        return position
+
+    def release(self, controllerID):
+        """Drops a controller from the queue, whether it is in control or still waiting."""
+        entry = self.entries.get(controllerID)
+        if entry is None:
+            return
+
+        entry.ttl = 0
+        self._expire(entry)
+
+    def advance(self, now):
+        """
+        Expires the current controller if its time is up and promotes the next valid one, dropping down priority levels
+        as they run out. Returns the controllerID now in control, or -1 if the queue is empty and patterns should run.
+        """
+        while True:
+            entry = self._nextInLine(now)
+            if entry is None:
+                if self.controlledBy != -1:
+                    print("Queue empty...")
+                self.controlledBy = -1
+                return -1
+
+            if entry.queuePosition == 0:
+                # Currently in control, check its validity.
+                if entry.acquire + entry.ttl > now:
+                    self.controlledBy = entry.controllerID
+                    return entry.controllerID
+
+                print("controllerID " + str(entry.controllerID) + " has expired, setting its queuePosition to -2.")
+                self._expire(entry)
+                continue
+
+            # Waiting controllers whose owners have released control (given up on) will have TTLs of 0.
+            if not entry.ttl > 0:
+                self._expire(entry)
+                continue
+
+            # This item needs to be promoted to the front of the queue. We keep the exact acquire time in memory so that
+            # handovers happen right on the deadline, the database only gets whole seconds.
+            if self.fair:
+                self.virtualTime[entry.priority] = entry.queuePosition
+            self._reposition(entry, 0)
+            entry.acquire = now
+            self._markDirty(entry.controllerID, 0, entry.acquire)
+            heapq.heappush(self.deadlines, (entry.acquire + entry.ttl, entry.controllerID))
+            print("New controllerID in control: " + str(entry.controllerID))
+
+            wait = now - entry.enqueued
+            self.longestWaits[entry.priority] = max(self.longestWaits.get(entry.priority, 0), wait)
+
+            self.controlledBy = entry.controllerID
+            return entry.controllerID
+
+    def nextDeadline(self):
+        """
+        Returns the earliest time at which a controller's control runs out, or None if nobody has control. Nothing in
+        the queue can change on its own before then, so the caller can sleep until this (or until woken by the API).
+        """
+        while self.deadlines:
+            deadline, controllerID = self.deadlines[0]
+            entry = self.entries.get(controllerID)
+            if entry is not None and entry.queuePosition == 0 and entry.acquire + entry.ttl == deadline:
+                return deadline
+            heapq.heappop(self.deadlines)
+        return None
+
+    def waitMetrics(self, now):
+        """
+        Returns {priority: seconds} with the longest wait at each priority level since the last call - whether that was
+        somebody who has since got control, or the first in line who is still waiting.
+        """
+        waits = self.longestWaits
+        for priority in self.counts:
+            waiting = self._firstWaiting(priority)
+            if waiting is not None:
+                waits[priority] = max(waits.get(priority, 0), now - waiting.enqueued)
+
+        self.longestWaits = {}
+        return waits
+
+    def takeDirty(self):
+        """Returns the changes which haven't been persisted yet as SET_QUEUE_POSITION_AND_ACQUIRE parameters."""
+        changes = [{'controllerID': cid, 'queuePosition': position, 'acquire': acquire}
+                   for cid, (position, acquire) in self.dirty.items()]
+        self.dirty = {}
+        return changes
+
+    def __len__(self):
+        return len(self.entries)
+
+    # ###
+    # Internal heap bookkeeping
+    # ###
+
+    def _insert(self, entry):
+        self.entries[entry.controllerID] = entry
+        heapq.heappush(self.queues.setdefault(entry.priority, []), (entry.queuePosition, entry.controllerID))
+
+        self.counts[entry.priority] = self.counts.get(entry.priority, 0) + 1
+        if entry.priority not in self.levelsInHeap:
+            heapq.heappush(self.levels, -entry.priority)
+            self.levelsInHeap.add(entry.priority)
+
+        if entry.queuePosition >= self.nextQueuePosition.get(entry.priority, 1):
+            self.nextQueuePosition[entry.priority] = entry.queuePosition + 1
+
+        if entry.queuePosition == 0:
+            heapq.heappush(self.deadlines, (entry.acquire + entry.ttl, entry.controllerID))
+
+    def _reposition(self, entry, position):
+        # The old heap item becomes stale and will be skipped by _head().
+        entry.queuePosition = position
+        heapq.heappush(self.queues[entry.priority], (position, entry.controllerID))
+
+    def _expire(self, entry):
+        del self.entries[entry.controllerID]
+        self._markDirty(entry.controllerID, -2, entry.acquire)
+
+        self.counts[entry.priority] -= 1
+        if self.counts[entry.priority] == 0:
+            # Like the original MAX(queuePosition) lookup, numbering restarts once a priority queue has emptied.
+            del self.counts[entry.priority]
+            del self.queues[entry.priority]
+            self.nextQueuePosition.pop(entry.priority, None)
+            self.virtualTime.pop(entry.priority, None)
+            self.finishTimes.pop(entry.priority, None)
+
+    def _head(self, priority):
+        heap = self.queues[priority]
+        while True:
+            position, controllerID = heap[0]
+            entry = self.entries.get(controllerID)
+            if entry is not None and entry.queuePosition == position:
+                return entry
+            heapq.heappop(heap)
+
+    def _firstWaiting(self, priority):
+        """Returns the first controller of a level which is still waiting, or None if nobody in it is."""
+        head = self._head(priority)
+        if head.queuePosition != 0:
+            return head
+        if self.counts[priority] == 1:
+            return None
+
+        # Only one controller of a level can be at position 0, so the one waiting is next once that's out of the way.
+        heap = self.queues[priority]
+        item = heapq.heappop(heap)
+        try:
+            return self._head(priority)
+        finally:
+            heapq.heappush(heap, item)
+
+    def _nextInLine(self, now):
+        # Strictly by priority, the first controller in the highest priority level is next in line.
+        priority = self._maxPriority()
+        if priority is None:
+            return None
+        if self.agingRate is None:
+            return self._head(priority)
+
+        # With aging, the current controller keeps control unless a higher priority request preempts it...
+        current = self.entries.get(self.controlledBy)
+        if current is not None and current.queuePosition == 0:
+            if priority > current.priority:
+                return self._head(priority)
+            return current
+
+        # ...and when control is up for grabs, it goes to the level with the highest effective priority. Controllers
+        # which were preempted and have run out of time since are expired here, as nothing else ever gets to them.
+        best = None
+        for priority in list(self.counts):
+            head = self._head(priority)
+            if head.queuePosition == 0 and head.acquire + head.ttl <= now:
+                print("controllerID " + str(head.controllerID) + " has expired, setting its queuePosition to -2.")
+                self._expire(head)
+                if priority not in self.counts:
+                    continue
+                head = self._head(priority)
+
+            # A preempted controller gets control back when its level's turn comes, but the level waits as long as the
+            # first controller in it who's still waiting.
+            waiting = self._firstWaiting(priority)
+            key = (self._effectivePriority(waiting if waiting is not None else head, now), priority)
+            if best is None or key > best[0]:
+                best = (key, head)
+        return best[1] if best is not None else None
+
+    def _effectivePriority(self, entry, now):
+        # A controller which has had control stops aging at the time it acquired it.
+        waitedUntil = entry.acquire if entry.queuePosition == 0 else now
+        return entry.priority + self.agingRate * max(0, waitedUntil - entry.enqueued)
+
+    def _maxPriority(self):
+        while self.levels:
+            priority = -self.levels[0]
+            if priority in self.counts:
+                return priority
+            heapq.heappop(self.levels)
+            self.levelsInHeap.discard(priority)
+        return None
+
+    def _markDirty(self, controllerID, position, acquire):
+        self.dirty[controllerID] = (position, int(acquire))
+
+
+class QueueIndex:
+    """
+    A read-only index of the live control queue, for answering "where am I, and how long until I get control?" without
+    walking the queue. Controllers are ordered by priority (highest first) and then queue position, and each priority
+    level keeps prefix sums of the TTLs of its waiting controllers. Building it is O(n), after that every lookup only
+    does O(1) work per priority level - and there are only ever a handful of those.
+    """
+
+    def __init__(self, rows):
+        """Builds the index from database rows of (controllerID, acquire, ttl, priority, queuePosition, ...)."""
+        byPriority = {}
+        for row in rows:
+            byPriority.setdefault(row[3], []).append(row)
+
+        self.levels = []  # One (controllerIDs, waitingTtlPrefix, headDeadline) per priority level, highest first.
+        self.where = {}  # controllerID -> (level index, index within the level, ttl).
+
+        for priority in sorted(byPriority.keys(), reverse=True):
+            level = sorted(byPriority[priority], key=lambda r: (r[4], r[0]))
+
+            # Only a controller at position 0 has acquired control, so it's the only one whose remaining time depends
+            # on the clock. Everybody else is waiting and still has their whole TTL ahead of them.
+            headDeadline = None
+            prefix = [0]
+            for i, row in enumerate(level):
+                if row[4] == 0:
+                    headDeadline = row[1] + row[2]
+                    prefix.append(prefix[-1])
+                else:
+                    prefix.append(prefix[-1] + row[2])
+                self.where[row[0]] = (len(self.levels), i, row[2])
+
+            self.levels.append(([row[0] for row in level], prefix, headDeadline))
+
+    def lookup(self, controllerID, now):
+        """
+        Returns (position, eta, remaining) for a controller: how many controllers are ahead of it across all priority
+        levels (0 if it is in control), roughly how many seconds until it gets control, and how many seconds of control
+        it has (left). Returns None if the controller isn't in the queue.
+        """
+        if controllerID not in self.where:
+            return None
+
+        levelIndex, index, ttl = self.where[controllerID]
+        position = 0
+        eta = 0
+
+        # Everybody in the higher priority levels is ahead of us...
+        for controllerIDs, prefix, headDeadline in self.levels[:levelIndex]:
+            position += len(controllerIDs)
+            eta += prefix[-1]
+            if headDeadline is not None:
+                eta += max(0, headDeadline - now)
+
+        # ...and so is everybody before us in our own level.
+        controllerIDs, prefix, headDeadline = self.levels[levelIndex]
+        position += index
+        eta += prefix[index]
+
+        if index == 0 and headDeadline is not None:
+            remaining = max(0, headDeadline - now)
+        else:
+            remaining = ttl
+            if headDeadline is not None:
+                eta += max(0, headDeadline - now)
+
+        return position, eta, remaining
@@ -0,0 +1,201 @@
+# ###
+# A local stand-in for the fountain's cRIO, for measuring the backend's output off-site. It listens for the frames the
+# background processing sends, decodes them back into valve states, and reports the timing of their arrival: the
+# interval between frames and its jitter, frames which seem to have been dropped, and the timeline of valve changes.
+#
+# Timeline chunks (opcode 0x02, see output.TimelineSender) are played back locally the way the cRIO would: each frame at
+# its own time on our clock, holding the last frame if the timeline runs out. The statistics are then of that playback.
+#
+# Usage: python simulator.py [--host 127.0.0.1] [--port 30096] [--rate 1] [--report 10]
+# Then start the backend with ENLIGHT_CRIO_HOST=127.0.0.1 (and ENLIGHT_CRIO_PORT, if the port isn't the default).
+# ###
+import argparse
+import socket
+from time import monotonic
+
+from output import FRAME, OPCODE_FRAME, OPCODE_TIMELINE, decodeTimeline, joinState
+
+
+class FrameStats:
+    """
+    Timing statistics for received frames. The backend sends a frame on every state change and every keepalive, so
+    with the keepalive set to the frame period a gap of more than 1.5 periods between frames means frames went missing.
+    """
+
+    def __init__(self, period):
+        self.period = period
+        self.frames = 0
+        self.drops = 0
+        self.intervals = []
+        self.lastArrival = None
+        self.lastState = None
+        self.timeline = []  # (arrival, state) for every change of state.
+
+    def record(self, arrival, state):
+        if self.lastArrival is not None:
+            interval = arrival - self.lastArrival
+            self.intervals.append(interval)
+            if interval > self.period * 1.5:
+                self.drops += int(round(interval / self.period)) - 1
+
+        if state != self.lastState:
+            self.timeline.append((arrival, state))
+
+        self.frames += 1
+        self.lastArrival = arrival
+        self.lastState = state
+
+    def report(self):
+        """Returns a summary of the frames since the last report, and starts counting afresh."""
+        lines = [str(self.frames) + " frames, " + str(self.drops) + " dropped"]
+
+        if self.intervals:
+            mean = sum(self.intervals) / len(self.intervals)
+            jitter = (sum((i - mean) ** 2 for i in self.intervals) / len(self.intervals)) ** 0.5
+            lines.append("interval mean " + ms(mean) + ", jitter (std dev) " + ms(jitter) + ", min " +
+                         ms(min(self.intervals)) + ", max " + ms(max(self.intervals)))
+
+        for arrival, state in self.timeline:
+            lines.append("  %10.3f  %s" % (arrival, valveString(state)))
+
+        self.frames = 0
+        self.drops = 0
+        self.intervals = []
+        self.timeline = []
+        return "\n".join(lines)
+
+
+class TimelinePlayer:
+    """
+    Plays timeline chunks back on the local clock. The first chunk anchors the stream: frame n plays at n periods after
+    the frame the chunk started with. Each chunk replaces what we had from its first frame on. If the backend restarts,
+    its frames start over from 0, which shows up as a chunk entirely in the past, so we anchor on that one afresh.
+    """
+
+    def __init__(self):
+        self.start = None
+        self.period = None
+        self.base = 0  # The index of the first frame in states...
+        self.states = []  # ...and the states still to play, along with the one playing now.
+        self.nextFrame = 0
+        self.underruns = 0  # Frames we had to hold the last state for, as the timeline had run out.
+        self.lateChunks = 0  # Chunks which changed frames we had already played.
+
+    def receive(self, arrival, firstFrame, period, states):
+        if self.start is None or period != self.period or firstFrame + len(states) <= self.nextFrame - 1:
+            self.start = arrival - firstFrame * period
+            self.period = period
+            self.base = firstFrame
+            self.states = states
+            self.nextFrame = firstFrame
+            return
+
+        if firstFrame < self.nextFrame - 1:
+            self.lateChunks += 1
+
+        kept = self.states[:max(0, firstFrame - self.base)]
+        if len(kept) < firstFrame - self.base:
+            kept += kept[-1:] * (firstFrame - self.base - len(kept))  # A gap, so hold what we had.
+        if firstFrame < self.base:
+            self.base = firstFrame
+        self.states = kept + states
+
+    def nextFrameAt(self):
+        """Returns when the next frame is due, or None if nothing has been received yet."""
+        if self.start is None:
+            return None
+        return self.start + self.nextFrame * self.period
+
+    def play(self):
+        """Returns the state of the frame which is now due, and moves on to the next."""
+        index = self.nextFrame - self.base
+        if index >= len(self.states):
+            self.underruns += 1
+            index = len(self.states) - 1
+
+        # Keep the frame playing now in case the timeline runs out, but nothing before it.
+        self.base += index
+        self.states = self.states[index:]
+        self.nextFrame += 1
+        return self.states[0]
+
+
+def ms(seconds):
+    return str(round(seconds * 1000, 2)) + " ms"
+
+
+def valveString(state):
+    """Shows a state as 24 valves, valve 1 first, with # for spraying and . for off."""
+    return ''.join('#' if state >> i & 1 else '.' for i in range(24))
+
+
+def decodeFrame(payload):
+    """Decodes an opcode 0x01 frame into a valve state bitmask, or returns None if it isn't one."""
+    if len(payload) != FRAME.size or payload[0] != OPCODE_FRAME:
+        return None
+
+    opcode, horizontals, verticals = FRAME.unpack(payload)
+    return joinState(horizontals, verticals)
+
+
+def simulate(host, port, period, reportInterval):
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    sock.bind((host, port))
+    print("Simulating the cRIO on " + host + ":" + str(port) + "...")
+
+    start = monotonic()
+    stats = FrameStats(period)
+    player = TimelinePlayer()
+    nextReport = start + reportInterval
+
+    try:
+        while True:
+            wakeAt = nextReport
+            if player.nextFrameAt() is not None:
+                wakeAt = min(wakeAt, start + player.nextFrameAt())
+            sock.settimeout(max(0, wakeAt - monotonic()))
+            try:
+                payload = sock.recv(2048)
+            except socket.timeout:
+                payload = None
+
+            arrival = monotonic() - start
+            if payload is not None and payload[:1] == bytes([OPCODE_TIMELINE]):
+                player.receive(arrival, *decodeTimeline(payload))
+            elif payload is not None:
+                state = decodeFrame(payload)
+                if state is None:
+                    print("Unknown frame: " + repr(payload))
+                else:
+                    stats.record(arrival, state)
+
+            # Play whichever streamed frames are due.
+            while player.nextFrameAt() is not None and player.nextFrameAt() <= monotonic() - start:
+                stats.record(monotonic() - start, player.play())
+
+            if monotonic() >= nextReport:
+                report(stats, player)
+                nextReport += reportInterval
+    except KeyboardInterrupt:
+        report(stats, player)
+    finally:
+        sock.close()
+
+
+def report(stats, player):
+    print(stats.report())
+    if player.start is not None:
+        print("timeline: " + str(player.underruns) + " underruns, " + str(player.lateChunks) + " late chunks")
+        player.underruns = 0
+        player.lateChunks = 0
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Stand-in for the fountain's cRIO, reporting on the frames it gets.")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=30096)
+    parser.add_argument('--rate', type=float, default=1.0, help="Expected frames per second, for spotting drops.")
+    parser.add_argument('--report', type=float, default=10.0, help="Seconds between reports.")
+    args = parser.parse_args()
+
+    simulate(args.host, args.port, 1.0 / args.rate, args.report)
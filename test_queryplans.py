@@ -0,0 +1,82 @@
+# ###
+# Checks that no query has to scan a whole table, other than the queries.ALLOWED_SCANS. A query which starts scanning
+# (because an index was dropped, or the query changed) fails this, rather than only slowing down the fountain.
+#
+# Usage: python -m unittest test_queryplans
+# ###
+import os
+import shutil
+import tempfile
+import unittest
+
+import constants
+import fountain
+
+
+# The tables as the backend first created them.
+ORIGINAL_SCHEMA = """
+    CREATE TABLE apikeys (
+        apikey TEXT PRIMARY KEY,
+        name TEXT NOT NULL,
+        priority INTEGER NOT NULL,
+        date INTEGER NOT NULL,
+        enabled INTEGER DEFAULT 1 NOT NULL
+    );
+    CREATE TABLE controlQueue (
+        controllerID INTEGER PRIMARY KEY AUTOINCREMENT,
+        acquire INTEGER NOT NULL,
+        ttl INTEGER NOT NULL,
+        priority INTEGER NOT NULL,
+        queuePosition INTEGER NOT NULL,
+        apikey REFERENCES apikeys (apikey)
+    );
+    CREATE TABLE valves (
+        ID INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT,
+        spraying INTEGER NOT NULL,
+        enabled INTEGER DEFAULT 1 NOT NULL
+    );
+    CREATE TABLE patterns (
+        ID INTEGER PRIMARY KEY,
+        name TEXT UNIQUE NOT NULL,
+        description TEXT,
+        active INTEGER NOT NULL,
+        enabled INTEGER DEFAULT 1 NOT NULL
+    );
+    CREATE TABLE patternData (
+        patternID REFERENCES patterns(ID),
+        time INTEGER NOT NULL,
+        valve REFERENCES valves(ID),
+        action INTEGER NOT NULL
+    );
+"""
+
+
+class QueryPlanTest(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.filename = constants.DB_FILENAME
+        constants.DB_FILENAME = os.path.join(self.directory, 'queryplans.sqlite')
+
+    def tearDown(self):
+        constants.DB_FILENAME = self.filename
+        shutil.rmtree(self.directory)
+
+    def test_createdTablesHaveNoScans(self):
+        fountain.db_createTables()
+        self.assertEqual(fountain.db_checkQueryPlans(), [])
+
+    def test_migratedTablesHaveNoScans(self):
+        # A database from before any of the indexes, columns, triggers and tables which db_migrate() adds.
+        con = fountain.db_connect()
+        con.executescript(ORIGINAL_SCHEMA)
+        fountain.db_close(con)
+
+        fountain.db_migrate()
+        self.assertEqual(fountain.db_checkQueryPlans(), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
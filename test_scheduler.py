@@ -0,0 +1,57 @@
+# ###
+# Checks the control queue scheduler's decisions, stepped through a simulated clock without any database.
+#
+# Usage: python -m unittest test_scheduler
+# ###
+import contextlib
+import io
+import unittest
+
+from scheduler import ControlScheduler
+
+
+class AgingTest(unittest.TestCase):
+
+    def test_preemptedControllerDoesNotStarveItsLevel(self):
+        # cID 1 (priority 10) is in control and cID 2 waits behind it when a stream of priority 30 requests starts,
+        # one every 10 seconds. cID 1 is preempted and stops aging, but cID 2 must still age into control.
+        scheduler = ControlScheduler(agingRate=0.1)
+        got = None
+        with contextlib.redirect_stdout(io.StringIO()):
+            scheduler.decide([(1, 10, 60, 'low'), (2, 10, 60, 'low')], [], 0)
+            nextID = 3
+            for now in range(1, 400):
+                pending = []
+                if now % 10 == 1:
+                    pending.append((nextID, 30, 10, 'high'))
+                    nextID += 1
+                if scheduler.decide(pending, [], now)[0] == 2:
+                    got = now
+                    break
+
+                if now == 100:
+                    self.assertEqual(scheduler.waitMetrics(now)[10], 100)
+
+        # 200 seconds of waiting lifts cID 2 to priority 30, level with the stream.
+        self.assertIsNotNone(got)
+        self.assertLess(got, 220)
+        self.assertNotIn(1, scheduler.entries)
+
+
+class FairQueueingTest(unittest.TestCase):
+
+    def test_reloadKeepsFinishTimes(self):
+        # 'spam' holds positions 60 to 180 when the scheduler is rebuilt from the database, as it is after a restart or
+        # a database error. Its next request must still go in behind its own, and a new key's in front of them.
+        rows = [(1, 0, 30, 10, 0, 'other')]
+        rows += [(2 + i, -1, 30, 10, 60 + 30 * i, 'spam') for i in range(5)]
+        scheduler = ControlScheduler(fair=True)
+        scheduler.load(rows, 0)
+
+        with contextlib.redirect_stdout(io.StringIO()):
+            self.assertEqual(scheduler.enqueue(10, 10, 30, 'spam', 0), 210)
+            self.assertEqual(scheduler.enqueue(11, 10, 30, 'new', 0), 89)
+
+
+if __name__ == '__main__':
+    unittest.main()